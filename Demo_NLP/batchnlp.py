@@ -0,0 +1,247 @@
+"""
+*****************************************************************************
+DESCRIPTION:
+
+This script runs the NLP experiments of the paper for several diseases and
+starting points (the runs of timeseriesnlp.py for several values of the
+options 1 and 2) from the command line.
+
+The seed x time point jobs of all the starting points of a disease are run
+on a single pool of worker processes, and the notes of the disease are
+loaded and concatenated once for all of them.
+
+Results are saved with the same names as timeseriesnlp.py:
+  --> {disease}{starting point}.pickle  (Ex: breast30.pickle),
+or {disease}{starting point}.parquet with --result_format slim, as soon as all the seeds of the starting point are completed. The
+experiments with an existing output file are skipped, and the seed x time
+point results are saved in checkpoints (--checkpoint_dir), so an
+interrupted batch is resumed by running the same command again.
+-----------------------------------------------------------------------------
+INSTRUCTIONS:
+
+Examples:
+  --> python batchnlp.py --diseases breast lung --starts 20 30 60 --n_jobs 8
+  --> python batchnlp.py --dry_run  (print the planned experiments only)
+
+The default values (all the diseases, starting points and seeds, the
+authors and additional columns) are the ones of timeseriesnlp.py.
+-----------------------------------------------------------------------------
+REQUIREMENTS:
+
+Same as timeseriesnlp.py (one file df_Notes_{disease}.pkl per disease, or
+the notes store given with --notes_store).
+-----------------------------------------------------------------------------
+AUTHORS: 
+
+  --> Jorge Barrios <Jorge.BarriosGinart@ucsf.edu>
+  --> Taman Upadhaya <tamanupadhaya@gmail.com>
+  --> Olivier Morin <olivier.morin@ucsf.edu>
+  --> Martin Vallières <martin.vallieres@usherbrooke.ca>
+-----------------------------------------------------------------------------
+STATEMENT:
+
+ This file is part of <https://github.com/medomics>, a package providing 
+ research utility tools for developing precision medicine applications.
+ --> Copyright (C) 2020  MEDomics consortium
+
+     This package is free software: you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation, either version 3 of the License, or
+     (at your option) any later version.
+
+     This package is distributed in the hope that it will be useful,
+     but WITHOUT ANY WARRANTY; without even the implied warranty of
+     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+     GNU General Public License for more details.
+ 
+     You should have received a copy of the GNU General Public License
+     along with this package.  If not, see <http://www.gnu.org/licenses/>.
+*****************************************************************************
+"""
+
+
+
+# ***************************************************************************
+import argparse
+import os
+import pickle
+import time
+from survivalnlp import (lr_cv_batch, NotesCorpus, load_arena,
+                         save_lr_cv_results)
+from timeseriesnlp import (cancer_type, start_points, select_period_points,
+                           survival_thr_list, random_state_list,
+                           authortype_list, added_features_list, cache_dir,
+                           checkpoint_dir, result_format, text_search,
+                           stage_search, search_jobs, oversampling,
+                           model_dir, memo_dir, trace_path, profile_stage)
+
+
+# ---------------------------------------------------------------------------
+# FUNCTIONS
+# ---------------------------------------------------------------------------
+def parse_arguments(argv=None):
+    """Command line options of the batch."""
+    parser = argparse.ArgumentParser(
+        description='NLP experiments for each disease x starting point x '
+                    'seed.')
+    parser.add_argument('--diseases', nargs='+', default=cancer_type,
+                        choices=cancer_type)
+    parser.add_argument('--starts', nargs='+', type=int,
+                        default=start_points, choices=start_points,
+                        help='Starting points in days.')
+    parser.add_argument('--seeds', nargs='+', type=int,
+                        default=random_state_list)
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='Number of worker processes.')
+    parser.add_argument('--text_search', default=text_search,
+                        choices=['grid', 'counts', 'path', 'halving'],
+                        help='Hyperparameter search of the text model.')
+    parser.add_argument('--stage_search', default=stage_search,
+                        choices=['grid', 'path', 'rates'],
+                        help='Hyperparameter search of the stage/grade '
+                             'model.')
+    parser.add_argument('--search_jobs', type=int, default=search_jobs,
+                        help='Number of worker processes of the text search '
+                             'of each job (counts, path or halving search '
+                             'only).')
+    parser.add_argument('--oversampling', default=oversampling,
+                        choices=['rows', 'weights'],
+                        help='Oversampling of the minority class: copies of '
+                             'the rows or sample weights.')
+    parser.add_argument('--output_dir', default='.',
+                        help='Folder of the {disease}{start} output '
+                             'files.')
+    parser.add_argument('--result_format', default=result_format,
+                        choices=['pickle', 'slim'],
+                        help='Pickle of the lr_cv outputs or compact Parquet '
+                             'file of save_lr_cv_results.')
+    parser.add_argument('--cache_dir', default=cache_dir,
+                        help='Folder of the cache of the tf-idf transforms.')
+    parser.add_argument('--checkpoint_dir', default=checkpoint_dir,
+                        help='Folder of the checkpoints of the seed x time '
+                             'point results (one subfolder per disease).')
+    parser.add_argument('--notes_store', default=None,
+                        help='Folder of the columnar notes store.')
+    parser.add_argument('--arena_dir', default=None,
+                        help='Folder of the text arenas (one subfolder per '
+                             'disease).')
+    parser.add_argument('--model_dir', default=model_dir,
+                        help='Folder of the final models of each seed and '
+                             'time point (one subfolder per disease).')
+    parser.add_argument('--memo_dir', default=memo_dir,
+                        help='Folder of the memo of the fitted searches and '
+                             'models, shared by the diseases.')
+    parser.add_argument('--trace_path', default=trace_path,
+                        help='JSON-lines file of the timers and peak memory '
+                             'of the stages of the experiments.')
+    parser.add_argument('--profile_stage', default=profile_stage,
+                        help='Stage run under cProfile (Ex: text_search), '
+                             'saved next to the trace.')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Print the planned experiments and exit.')
+    return parser.parse_args(argv)
+
+
+def plan_batch(diseases, starts, output_dir='.', result_format='pickle'):
+    """List of (disease, experiments) where 'experiments' is the list of
+    (start, period_points, output file) of the starting points without an
+    output file."""
+    extension = '.parquet' if result_format == 'slim' else '.pickle'
+    plan = []
+    for disease in diseases:
+        experiments = []
+        for start in starts:
+            output = os.path.join(output_dir, f'{disease}{start}{extension}')
+            if os.path.exists(output):
+                print(f'{output} already exists (skipped).')
+                continue
+            experiments.append((start,
+                                select_period_points(start_points.index(start)),
+                                output))
+        if experiments:
+            plan.append((disease, experiments))
+    return plan
+
+
+def save_results(results_list, output):
+    """Pickle the results of one experiment. The file is written under a
+    temporary name and renamed, so a partial file is never taken as a
+    completed experiment."""
+    with open(output + '.tmp', 'wb') as f:
+        pickle.dump(results_list, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(output + '.tmp', output)
+
+
+def run_batch(args):
+    """Run the experiments of the batch, disease by disease."""
+    plan = plan_batch(args.diseases, args.starts, output_dir=args.output_dir,
+                      result_format=args.result_format)
+    for disease, experiments in plan:
+        n_jobs = len(args.seeds)*sum(len(period_points)
+                                     for _, period_points, _ in experiments)
+        print(f'{disease}: starts {[start for start, _, _ in experiments]}, '
+              f'{len(args.seeds)} seeds, {n_jobs} jobs.')
+    if args.dry_run:
+        return
+
+    for disease, experiments in plan:
+        year_survival = survival_thr_list[cancer_type.index(disease)]
+
+        # Load the notes once for all the starting points and seeds.
+        corpus = NotesCorpus(disease, year_survival=year_survival,
+                             authortype_list=authortype_list,
+                             store=args.notes_store,
+                             added_features_list=added_features_list)
+        arena_dir = None
+        if args.arena_dir is not None:
+            arena_dir = os.path.join(args.arena_dir, disease)
+            # Only the arena is read by the runs: free the texts.
+            load_arena(corpus, arena_dir, added_features_list)
+            corpus.release_texts()
+        disease_checkpoint_dir = None
+        if args.checkpoint_dir is not None:
+            disease_checkpoint_dir = os.path.join(args.checkpoint_dir, disease)
+        disease_model_dir = None
+        if args.model_dir is not None:
+            disease_model_dir = os.path.join(args.model_dir, disease)
+
+        results = lr_cv_batch(corpus,
+                              [period_points for _, period_points, _
+                               in experiments],
+                              args.seeds,
+                              year_survival=year_survival,
+                              authortype_list=authortype_list,
+                              added_features_list=added_features_list,
+                              cache_dir=args.cache_dir,
+                              arena_dir=arena_dir,
+                              checkpoint_dir=disease_checkpoint_dir,
+                              text_search=args.text_search,
+                              stage_search=args.stage_search,
+                              oversampling=args.oversampling,
+                              n_jobs=args.n_jobs,
+                              search_jobs=args.search_jobs,
+                              model_dir=disease_model_dir,
+                              memo_dir=args.memo_dir,
+                              trace_path=args.trace_path,
+                              profile_stage=args.profile_stage)
+        for k, results_list in results:
+            if args.result_format == 'slim':
+                save_lr_cv_results(results_list, experiments[k][2],
+                                   corpus=corpus)
+            else:
+                save_results(results_list, experiments[k][2])
+            print(f'{experiments[k][2]} saved.')
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# COMPUTATIONS
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+    start = time.time()
+    run_batch(parse_arguments())
+    print('---DONE!---')
+    print('Execution Time: ', time.time() - start)
+# ---------------------------------------------------------------------------
+
+# ***************************************************************************
@@ -0,0 +1,409 @@
+"""
+*****************************************************************************
+DESCRIPTION:
+
+This script measures the performance of the NLP experiments, on the notes
+of a disease or on synthetic notes (--synthetic_patients), which have the
+format of df_Notes_{disease}.pkl and realistic numbers and lengths of notes.
+
+Benchmarks:
+  --> vectorizer: wall time and scores (cross validation AUC and F1 of the
+      best candidate, test AUC and F1) of the tf-idf of the terms
+      ('tokens') vs the tf-idf of the hashed terms ('hashing'), with the
+      counts search of the text model.
+  --> halving: wall time, scores and selected hyperparameters (max_features
+      and C of the text model) of the successive halving search
+      (text_search='halving') vs the full grid search.
+  --> scaling: wall time and peak memory (RSS) of combined_notes, of the
+      tf-idf fits, of the grid search of the text model and of lr_cv, on
+      synthetic notes of several numbers of patients (--patients). Each
+      step runs in a new process. With --baseline (CSV file of a previous
+      run), the steps slower or larger than the baseline by more than
+      --tolerance are flagged as regressions (the exit status is then 1).
+  --> synthetic: save synthetic notes in df_Notes_{disease}.pkl (or
+      --output), to run the other scripts without the notes of the
+      patients.
+
+The table of each benchmark is printed and saved in a CSV file (--output).
+-----------------------------------------------------------------------------
+INSTRUCTIONS:
+
+Examples:
+  --> python benchmarknlp.py vectorizer --disease breast --periods 30 365
+  --> python benchmarknlp.py vectorizer --synthetic_patients 2000
+  --> python benchmarknlp.py halving --disease breast --periods 30 365
+  --> python benchmarknlp.py scaling --patients 500 1000 2000 \
+          --output scaling.csv
+  --> python benchmarknlp.py scaling --baseline scaling.csv
+  --> python benchmarknlp.py synthetic --synthetic_patients 2000
+-----------------------------------------------------------------------------
+REQUIREMENTS:
+
+Same as timeseriesnlp.py (file df_Notes_{disease}.pkl, or the notes store
+given with --notes_store), except with synthetic notes.
+-----------------------------------------------------------------------------
+AUTHORS:
+
+  --> Jorge Barrios <Jorge.BarriosGinart@ucsf.edu>
+  --> Taman Upadhaya <tamanupadhaya@gmail.com>
+  --> Olivier Morin <olivier.morin@ucsf.edu>
+  --> Martin Vallières <martin.vallieres@usherbrooke.ca>
+-----------------------------------------------------------------------------
+STATEMENT:
+
+ This file is part of <https://github.com/medomics>, a package providing
+ research utility tools for developing precision medicine applications.
+ --> Copyright (C) 2020  MEDomics consortium
+
+     This package is free software: you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation, either version 3 of the License, or
+     (at your option) any later version.
+
+     This package is distributed in the hope that it will be useful,
+     but WITHOUT ANY WARRANTY; without even the implied warranty of
+     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+     GNU General Public License for more details.
+
+     You should have received a copy of the GNU General Public License
+     along with this package.  If not, see <http://www.gnu.org/licenses/>.
+*****************************************************************************
+"""
+
+
+
+# ***************************************************************************
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from sklearn.metrics import make_scorer, roc_auc_score, f1_score
+from sklearn.model_selection import GridSearchCV
+from imblearn.pipeline import Pipeline
+from survivalnlp import (lr_cv, NotesCorpus, combined_notes,
+                         train_test_sets, tokenize_documents,
+                         TokenTfidfVectorizer, CatStratifiedKFold,
+                         oversampled_lr_steps, peak_rss_mb)
+from timeseriesnlp import (cancer_type, survival_thr_list, authortype_list,
+                           added_features_list)
+
+
+# ---------------------------------------------------------------------------
+# PARAMETERS OPTIONS
+# ---------------------------------------------------------------------------
+# lr_cv settings compared by each benchmark.
+benchmarks = {
+    'vectorizer': {'tokens': dict(text_search='counts', vectorizer='tokens'),
+                   'hashing': dict(text_search='counts',
+                                   vectorizer='hashing')},
+    'halving': {'grid': dict(text_search='grid'),
+                'halving': dict(text_search='halving')},
+}
+
+# Steps of the scaling benchmark.
+scaling_steps = ['combined_notes', 'tfidf', 'grid_search', 'lr_cv']
+
+# Authors of the synthetic notes and their frequencies (the last two are not
+# in authortype_list, so they are removed by the filters of the notes).
+synthetic_authors = {'Physician': 0.4, 'Imaging-Narrative': 0.15,
+                     'Imaging-Impression': 0.15,
+                     'Pathology-Impression': 0.1, 'Nursing': 0.1,
+                     'Social-Work': 0.1}
+
+# Terms of the synthetic notes related to a poor and a good prognosis.
+synthetic_prognosis_terms = (['metastatic', 'progression', 'recurrence',
+                              'hospice', 'palliative', 'decline'],
+                             ['stable', 'remission', 'resolved', 'benign',
+                              'tolerating', 'improved'])
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# FUNCTIONS
+# ---------------------------------------------------------------------------
+def parse_arguments(argv=None):
+    """Command line options of the benchmark."""
+    parser = argparse.ArgumentParser(
+        description='Performance of the NLP experiments.')
+    parser.add_argument('benchmark',
+                        choices=list(benchmarks) + ['scaling', 'synthetic'])
+    parser.add_argument('--disease', default=cancer_type[0],
+                        choices=cancer_type)
+    parser.add_argument('--periods', nargs='+', type=int, default=[30, 365],
+                        help='Time points in days.')
+    parser.add_argument('--seed', type=int, default=3)
+    parser.add_argument('--notes_store', default=None,
+                        help='Folder of the columnar notes store.')
+    parser.add_argument('--synthetic_patients', type=int, default=None,
+                        help='Number of patients of the synthetic notes '
+                             '(used instead of the notes of the disease).')
+    parser.add_argument('--patients', nargs='+', type=int,
+                        default=[250, 500, 1000],
+                        help='Numbers of patients of the scaling benchmark.')
+    parser.add_argument('--baseline', default=None,
+                        help='CSV file of a previous scaling benchmark.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative increase of the wall time or of the '
+                             'peak memory flagged as a regression.')
+    parser.add_argument('--output', default=None,
+                        help='CSV file of the table of the benchmark '
+                             '(pickle of the notes for synthetic).')
+    return parser.parse_args(argv)
+
+
+def synthetic_notes(n_patients=1000, random_state=0, n_terms=20000,
+                    mean_notes=30, median_note_length=80):
+    """
+    This function returns a DataFrame of random notes with the columns of
+    df_Notes_{disease}.pkl (and 'AGE'). The numbers of notes of the patients
+    follow a negative binomial distribution (mean 'mean_notes'), the numbers
+    of terms of the notes a log-normal distribution (median
+    'median_note_length') and the terms a Zipf-Mandelbrot distribution over
+    'n_terms' terms. Most notes are written in the first weeks after the
+    diagnosis, a few before it, and none after the death. The survival
+    depends on the stage and on a hidden risk, which also sets the
+    frequency of terms of poor and good prognosis in the notes.
+
+    Parameters
+    ----------
+     n_patients:
+         Number of patients.
+     random_state:
+         Seed used by the random number generator.
+     n_terms:
+         Number of terms of the vocabulary.
+     mean_notes:
+         Mean number of notes of a patient.
+     median_note_length:
+         Median number of terms of a note.
+    """
+    rng = np.random.default_rng(random_state)
+
+    # Patients.
+    stage = rng.choice(4, size=n_patients, p=[0.3, 0.3, 0.25, 0.15])
+    risk = 0.6*stage + rng.normal(size=n_patients)
+    survival = rng.exponential(6*np.exp(-0.5*risk))  # Years.
+    follow_up = rng.uniform(0.5, 12, size=n_patients)
+    dateofdiagnosis = (pd.Timestamp('2005-01-01') +
+                       pd.to_timedelta(rng.integers(0, 5000, n_patients),
+                                       unit='D'))
+    age = np.clip(rng.normal(62, 12, n_patients), 18, 95).astype(int)
+
+    # Notes of each patient.
+    n_notes = rng.negative_binomial(1.5, 1.5/(1.5 + mean_notes - 1),
+                                    size=n_patients) + 1
+    patient = np.repeat(np.arange(n_patients), n_notes)
+    n = len(patient)
+    days = np.where(rng.random(n) < 0.35, rng.uniform(0, 60, n),
+                    rng.exponential(500, n))
+    days = np.where(rng.random(n) < 0.1, -rng.uniform(0, 365, n), days)
+    days = np.minimum(days, 365*np.minimum(survival, follow_up)[patient])
+
+    # Terms of each note, plus the terms of prognosis.
+    lengths = np.clip(np.round(rng.lognormal(np.log(median_note_length), 1.0,
+                                             n)), 1, 5000).astype(int)
+    vocabulary = np.array([f'w{k}' for k in range(n_terms)], dtype=object)
+    frequencies = 1/(np.arange(n_terms) + 2.7)**1.07
+    terms = vocabulary[rng.choice(n_terms, size=lengths.sum(),
+                                  p=frequencies/frequencies.sum())]
+    poor, good = (np.array(prognosis, dtype=object)
+                  for prognosis in synthetic_prognosis_terms)
+    n_prognosis = rng.poisson(2, n)
+    is_poor = rng.random(n_prognosis.sum()) < 1/(1 + np.exp(
+        -2*(np.repeat(risk[patient], n_prognosis) - 1)))
+    prognosis = np.where(is_poor, rng.choice(poor, len(is_poor)),
+                         rng.choice(good, len(is_poor)))
+    notes = [' '.join(note_terms) + ' ' + ' '.join(note_prognosis) + '.'
+             for note_terms, note_prognosis in zip(
+                 np.split(terms, np.cumsum(lengths)[:-1]),
+                 np.split(prognosis, np.cumsum(n_prognosis)[:-1]))]
+    notes = np.array(notes, dtype=object)
+    notes[rng.random(n) < 0.01] = None
+
+    return pd.DataFrame({
+        'id': patient,
+        'deid_notecontent': notes,
+        'overallsurvival': np.minimum(survival, follow_up)[patient],
+        'vitalstatusbinary': (survival <= follow_up).astype(int)[patient],
+        'authortype': rng.choice(list(synthetic_authors), size=n,
+                                 p=list(synthetic_authors.values())),
+        'filingdate': dateofdiagnosis[patient] + pd.to_timedelta(days,
+                                                                 unit='D'),
+        'dateofdiagnosis': dateofdiagnosis[patient],
+        'stage_grade': np.array(['1', '2', '3', '4'])[stage][patient],
+        'AGE': age[patient]})
+
+
+def load_notes(disease, year_survival, notes_store=None,
+               synthetic_patients=None):
+    """NotesCorpus of the notes of 'disease', or of synthetic notes of
+    'synthetic_patients' patients."""
+    df_Notes = None
+    if synthetic_patients is not None:
+        df_Notes = synthetic_notes(synthetic_patients)
+        notes_store = None
+    return NotesCorpus(disease, year_survival=year_survival,
+                       authortype_list=authortype_list, df_Notes=df_Notes,
+                       store=notes_store,
+                       added_features_list=added_features_list)
+
+
+def run_benchmark(settings, disease, periods, random_state=3,
+                  notes_store=None, synthetic_patients=None):
+    """Run lr_cv with each of the 'settings' (dictionary name: keyword
+    arguments of lr_cv) on the same notes and return a DataFrame with the
+    wall time and the scores of each setting and time point."""
+    year_survival = survival_thr_list[cancer_type.index(disease)]
+    corpus = load_notes(disease, year_survival, notes_store=notes_store,
+                        synthetic_patients=synthetic_patients)
+    rows = []
+    for name, options in settings.items():
+        start = time.time()
+        results = lr_cv(corpus, year_survival=year_survival,
+                        period_of_analysis_days=periods,
+                        random_state=random_state,
+                        authortype_list=authortype_list,
+                        added_features_list=added_features_list, **options)
+        wall_time = time.time() - start
+        for k, period in enumerate(periods):
+            rows.append(dict(setting=name, period=period,
+                             wall_time=wall_time,
+                             val_auc=results['val_area_under_curve'][k][0],
+                             val_f1=results['val_f1'][k][0],
+                             tfidf_param=results['tfidf_param_text'][k],
+                             C_param=results['C_param_text'][k],
+                             auc=results['area_under_curve'][k][0],
+                             f1=results['f1'][k][0]))
+    return pd.DataFrame(rows)
+
+
+def run_scaling_step(step, n_patients, periods, random_state=3):
+    """Run one step of the scaling benchmark on the synthetic notes of
+    'n_patients' patients and return its row of the table (the inputs of
+    the step are prepared before the measure)."""
+    year_survival = 5
+    corpus = load_notes('synthetic', year_survival,
+                        synthetic_patients=n_patients)
+    options = dict(year_survival=year_survival,
+                   authortype_list=authortype_list,
+                   added_features_list=added_features_list)
+    if step in ('tfidf', 'grid_search'):
+        # Training set of the last time point, as in lr_cv.
+        train, _ = train_test_sets(
+            combined_notes(corpus, period=periods[-1], **options),
+            random_state=random_state,
+            added_features_list=added_features_list)
+        y_train = train['label'].values.copy()
+
+    start_rss = peak_rss_mb()
+    start = time.time()
+    if step == 'combined_notes':
+        for period in periods:
+            combined_notes(corpus, period=period, **options)
+    elif step == 'tfidf':
+        documents, _ = tokenize_documents(train['text'].tolist())
+        for max_features in [500, 1000, None]:
+            TokenTfidfVectorizer(min_df=3, max_df=0.9, use_idf=1,
+                                 smooth_idf=1, sublinear_tf=1,
+                                 max_features=max_features
+                                 ).fit_transform(documents)
+    elif step == 'grid_search':
+        documents, _ = tokenize_documents(train['text'].tolist())
+        pipeline = Pipeline([('tfidfvectorizer',
+                              TokenTfidfVectorizer(min_df=3, max_df=0.9,
+                                                   use_idf=1, smooth_idf=1,
+                                                   sublinear_tf=1))]
+                            + oversampled_lr_steps(random_state))
+        GridSearchCV(pipeline,
+                     param_grid={'logisticregression__C':
+                                 [0.1, 1, 10, 100, 1000],
+                                 'tfidfvectorizer__max_features':
+                                 [500, 1000, None]},
+                     scoring={'f1': make_scorer(f1_score, average='macro'),
+                              'auc': make_scorer(roc_auc_score)},
+                     refit='f1',
+                     cv=CatStratifiedKFold(n_splits=5, shuffle=True,
+                                           random_state=random_state).split(
+                         train[['stage_grade']], y_train)
+                     ).fit(documents, y_train)
+    else:
+        lr_cv(corpus, period_of_analysis_days=periods,
+              random_state=random_state, **options)
+    wall_time = time.time() - start
+
+    return dict(step=step, patients=n_patients, notes=len(corpus.df_Notes),
+                wall_time=wall_time, start_rss_mb=start_rss,
+                peak_rss_mb=peak_rss_mb())
+
+
+def run_scaling(patients_list, periods, random_state=3, baseline=None,
+                tolerance=0.2):
+    """
+    This function runs every step of the scaling benchmark for each number
+    of patients in 'patients_list', each one in a new process, and returns
+    a DataFrame with the wall time and the peak memory (RSS, including the
+    memory of the process before the step, 'start_rss_mb') of each step.
+    With 'baseline' (DataFrame of a previous run), the column 'regression'
+    flags the steps with a wall time or a peak memory larger than the
+    baseline by more than 'tolerance' (relative increase).
+    """
+    rows = []
+    for n_patients in patients_list:
+        for step in scaling_steps:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                rows.append(executor.submit(run_scaling_step, step,
+                                            n_patients, periods,
+                                            random_state).result())
+    table = pd.DataFrame(rows)
+    if baseline is not None:
+        table = table.merge(
+            baseline[['step', 'patients', 'wall_time', 'peak_rss_mb']],
+            on=['step', 'patients'], how='left', suffixes=('', '_baseline'))
+        table['regression'] = (
+            (table['wall_time'] >
+             (1 + tolerance)*table['wall_time_baseline']) |
+            (table['peak_rss_mb'] >
+             (1 + tolerance)*table['peak_rss_mb_baseline']))
+    return table
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# COMPUTATIONS
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+    args = parse_arguments()
+    if args.benchmark == 'synthetic':
+        output = args.output or f'df_Notes_{args.disease}.pkl'
+        if os.path.exists(output):
+            sys.exit(f'{output} already exists.')
+        synthetic_notes(args.synthetic_patients or 1000,
+                        random_state=args.seed).to_pickle(output)
+        print(f'{output} saved.')
+        sys.exit()
+
+    if args.benchmark == 'scaling':
+        baseline = None
+        if args.baseline is not None:
+            baseline = pd.read_csv(args.baseline)
+        table = run_scaling(args.patients, args.periods,
+                            random_state=args.seed, baseline=baseline,
+                            tolerance=args.tolerance)
+    else:
+        table = run_benchmark(benchmarks[args.benchmark], args.disease,
+                              args.periods, random_state=args.seed,
+                              notes_store=args.notes_store,
+                              synthetic_patients=args.synthetic_patients)
+    print(table.to_string(index=False))
+    if args.output is not None:
+        table.to_csv(args.output, index=False)
+    if 'regression' in table and table['regression'].any():
+        print('Regressions:')
+        print(table[table['regression']].to_string(index=False))
+        sys.exit(1)
+# ---------------------------------------------------------------------------
+
+# ***************************************************************************
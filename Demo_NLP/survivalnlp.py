@@ -37,25 +37,43 @@ STATEMENT:
 # ************************************************************************
 import warnings
 import string
+import os
 import re
+import json
+import hashlib
+import copy
+import time
+import resource
+import sys
+import cProfile
 
 from shutil import rmtree
-from tempfile import mkdtemp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tempfile import mkdtemp, mkstemp
 from datetime import timedelta
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from scipy.stats import rankdata
 
+from sklearn.base import BaseEstimator, TransformerMixin, clone
 from sklearn.metrics import make_scorer, roc_auc_score
 from sklearn.metrics import f1_score
 from sklearn.model_selection import GridSearchCV, StratifiedKFold
+from sklearn.model_selection import ParameterGrid
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.feature_selection import SelectFromModel
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, TfidfTransformer
 from sklearn.linear_model import LogisticRegression
+from sklearn.utils import murmurhash3_32
 
-from joblib import Memory
+from joblib import dump, load
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from joblib import hash as joblib_hash
 from imblearn.pipeline import Pipeline
 from imblearn.over_sampling import RandomOverSampler
 
@@ -66,55 +84,58 @@ warnings.filterwarnings('ignore')
 # HELPER FUNCTIONS AND CLASSES
 # ---------------------------------------------------------------------------
 
+def nested_train_test_indices(df, labels_col_names, train_frac=0.8,
+                              random_state=42):
+    """This function perform a nested stratification in training/test set and
+    returns the positions (integer index arrays) of the training and test
+    rows of 'df'. 'labels_col_names' is a list of two values represent the
+    category and label used in the nested stratification. The rows of the
+    (category, label) pairs with a single member are added to the training
+    set, and the rows with a missing category or label are dropped."""
+
+    count = pd.merge(df[labels_col_names],
+                     df.groupby(labels_col_names).size().to_frame(name='count').reset_index(),
+                     on=labels_col_names,
+                     how='left')['count'].to_numpy()
+
+    one_member = np.flatnonzero(count == 1)
+    if len(one_member):
+        train_frac = (train_frac*len(df)-len(one_member))/(len(df)-len(one_member))
+    several = np.flatnonzero(count > 1)
+
+    category = df[labels_col_names[0]].iloc[several].reset_index(drop=True)
+    category_str = category.astype(str).to_numpy()
+    labels = df[labels_col_names[1]].to_numpy()[several]
+
+    i_train = []
+    i_test = []
+    for i in category.value_counts().index:
+        members = np.flatnonzero(category_str == i)
+        i_tr, i_te = train_test_split(members,
+                                      train_size=train_frac,
+                                      stratify=labels[members],
+                                      random_state=random_state)
+        i_train.append(several[i_tr])
+        i_test.append(several[i_te])
+    i_train.append(one_member)
+
+    return np.concatenate(i_train), np.concatenate(i_test)
+
+
 def nested_train_test_split(df, examples_col_names, labels_col_names,
                             train_frac=0.8, random_state=42):
     """This function perform a nested stratification in training/test set.
     'labels_col_names' is a list of two values represent the category and label
-    used in the nested stratification."""
+    used in the nested stratification. The sets have the label column
+    followed by the columns in 'examples_col_names'."""
+
+    i_train, i_test = nested_train_test_indices(df, labels_col_names,
+                                                train_frac=train_frac,
+                                                random_state=random_state)
+    columns = list(dict.fromkeys([labels_col_names[1]] + examples_col_names))
+    train = df[columns].iloc[i_train].reset_index(drop=True)
+    test = df[columns].iloc[i_test].reset_index(drop=True)
 
-    df = pd.merge(df,
-                  df.groupby(labels_col_names).size().to_frame(name = 'count').reset_index(), 
-                  on=labels_col_names, 
-                  how='left')
-    
-    train_one_member = None
-    if 1 in df['count'].values:
-        train_one_member = df[df['count']==1].copy().reset_index(drop=True)
-        train_frac = (train_frac*len(df)-len(train_one_member))/(len(df)-len(train_one_member))
-        df = df[df['count']>1].copy().reset_index(drop=True)
-
-    # Dropping some columns 
-    df.drop(columns =["count"], inplace = True)
-    
-    labels_list_0 = df[labels_col_names[0]].value_counts().index.tolist()
-    train = None
-    test = None
-
-    for i in labels_list_0:
-        labels = df[df[labels_col_names[0]].astype(str) == i][labels_col_names[1]].copy()
-        labels.reset_index(inplace=True, drop=True)
-        examples = df[df[labels_col_names[0]].astype(str) == i][examples_col_names].copy()
-        examples.reset_index(inplace=True, drop=True)
-        
-        X_tr, X_te, y_tr, y_te = train_test_split(examples,
-                                                  labels,
-                                                  train_size=train_frac,
-                                                  stratify=labels,
-                                                  random_state=random_state)
-        
-        train_i = pd.concat([y_tr, X_tr], axis=1).reset_index(drop=True)
-        train_i = train_i.loc[:,~train_i.columns.duplicated()]
-        test_i = pd.concat([y_te, X_te], axis=1).reset_index(drop=True)
-        test_i = test_i.loc[:,~test_i.columns.duplicated()]
-        if train is None:
-            train = train_i
-            test = test_i
-        else:
-            train = pd.concat([train, train_i], axis=0, ignore_index=True)
-            test = pd.concat([test, test_i], axis=0, ignore_index=True)
-    if  train_one_member is not None:       
-        train = pd.concat([train, train_one_member[train.columns]], axis=0, ignore_index=True)
-    
     return train, test
 
 
@@ -166,37 +187,680 @@ class CatStratifiedKFold:
         self.shuffle = shuffle
 
     def split(self, X, y):
-        categories = X['stage_grade'].value_counts().index.tolist()
-        X_idx = [0]*len(categories)
-        y_val = [0]*len(categories)
-        skf = [0]*len(categories)
-        for k, j in enumerate(categories):
-            X_idx[k] = X[X['stage_grade'] == j].copy().index
-            y_val[k] = y[X['stage_grade'] == j].copy()
-            skf[k] = StratifiedKFold(n_splits=self.n_splits,
-                                     random_state=self.random_state,
-                                     shuffle=self.shuffle).split(X_idx[k],
-                                                                 y_val[k])
+        y = np.asarray(y)
+        index = X.index.to_numpy()
+        stage_grade = X['stage_grade']
+        members = [np.flatnonzero((stage_grade == j).to_numpy())
+                   for j in stage_grade.value_counts().index]
+        skf = [StratifiedKFold(n_splits=self.n_splits,
+                               random_state=self.random_state,
+                               shuffle=self.shuffle).split(np.zeros(len(m)),
+                                                           y[m])
+               for m in members]
 
         for indexes in zip(*skf):
-            i_train = []
-            i_test = []
-            for i, index in enumerate(indexes):
-                i_train += X_idx[i][list(index[0])].tolist()
-                i_test += X_idx[i][list(index[1])].tolist()
-            yield np.array(i_train), np.array(i_test)
+            yield (np.concatenate([index[m[i_train]] for m, (i_train, _)
+                                   in zip(members, indexes)]),
+                   np.concatenate([index[m[i_test]] for m, (_, i_test)
+                                   in zip(members, indexes)]))
 
     def get_n_splits(self):
         return self.n_splits
+
+
+def dump_atomic(value, path):
+    """This function saves 'value' with joblib dump in 'path'. The file is
+    written under a temporary name in the same folder first, so other
+    processes (or a run restarted after a crash) never read a partial
+    file."""
+    fd, tmp_path = mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        dump(value, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class TransformerCache:
+    """TransformerCache
+    Persistent cache of the fitted transformers of the lr_cv pipelines, with
+    the joblib Memory interface used by Pipeline(memory=...). Each entry is
+    addressed by a hash of the inputs (texts or token ids and labels) and of
+    the transformer with its parameters, so it is reused between time
+    points, seeds and runs. When the entries exceed 'max_bytes', the least
+    recently used ones are deleted. Without 'location', a temporary folder
+    is used and clear() deletes it.
+    """
+
+    def __init__(self, location=None, max_bytes=8e9):
+        self.is_temporary = location is None
+        self.location = mkdtemp() if location is None else location
+        self.max_bytes = max_bytes
+        os.makedirs(self.location, 0o777, True)
+        self.evict()
+
+    def cache(self, func):
+        def cached_func(*args, **kwargs):
+            key = joblib_hash((func.__module__, func.__name__, args, kwargs))
+            return self.cached_call(key, func, *args, **kwargs)
+        return cached_func
+
+    def cached_call(self, key, func, *args, **kwargs):
+        path = os.path.join(self.location, key + '.pkl')
+        try:
+            return self.read(path)
+        except KeyError:
+            pass
+        output = func(*args, **kwargs)
+        self.store(path, output)
+        return output
+
+    def read(self, path):
+        """Value of the entry 'path' (marked as the most recently used).
+        A missing entry raises a KeyError, and a truncated or corrupt one is
+        deleted and treated as missing."""
+        try:
+            output = load(path)
+        except FileNotFoundError:
+            raise KeyError(path)
+        except Exception:
+            # The unpickler raises various errors (UnpicklingError,
+            # EOFError, ValueError, struct.error...) on a bad file.
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            raise KeyError(path)
+        try:
+            os.utime(path)  # Most recently used.
+        except OSError:
+            pass
+        return output
+
+    def store(self, path, output):
+        dump_atomic(output, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.location):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def clear(self):
+        if self.is_temporary:
+            rmtree(self.location, ignore_errors=True)
+
+
+class FitMemo(TransformerCache):
+    """FitMemo
+    Persistent memo of the model fits of lr_cv (hyperparameter searches,
+    folds of CountsSearchCV and final models), shared by the seeds, the
+    worker processes and the runs. A fit is addressed by a fingerprint of
+    the corpus ('context', see NotesCorpus.version), of the time point and
+    ids of the training (and validation) patients, and of the
+    hyperparameters of the models (see model_parameters), instead of a hash
+    of the data, so the identical fits of several seeds or runs are
+    computed once. The entries are stored and evicted as in
+    TransformerCache.
+    """
+
+    def __init__(self, location, context=None, max_bytes=8e9):
+        super().__init__(location, max_bytes=max_bytes)
+        self.context = context
+
+    def fingerprint(self, key):
+        return joblib_hash((self.context, key))
+
+    def fetch(self, key):
+        """Value memoized under 'key' (None when it is missing)."""
+        try:
+            return self.read(os.path.join(self.location,
+                                          self.fingerprint(key) + '.pkl'))
+        except KeyError:
+            return None
+
+    def save(self, key, output):
+        self.store(os.path.join(self.location,
+                                self.fingerprint(key) + '.pkl'), output)
+
+    def memoize(self, key, func, *args, **kwargs):
+        """func(*args, **kwargs), memoized under 'key'."""
+        return self.cached_call(self.fingerprint(key), func, *args, **kwargs)
+
+
+def memoize(memo, key, func, *args, **kwargs):
+    """func(*args, **kwargs), memoized under 'key' in the FitMemo 'memo'
+    (computed when 'memo' is None)."""
+    if memo is None:
+        return func(*args, **kwargs)
+    return memo.memoize(key, func, *args, **kwargs)
+
+
+def model_parameters(estimator):
+    """Class and parameters of 'estimator' and of its steps (without the
+    'memory' of the pipelines), used in the keys of FitMemo."""
+    parameters = [(name, type(value).__name__
+                   if isinstance(value, BaseEstimator) else value)
+                  for name, value in estimator.get_params(deep=True).items()
+                  if name not in ('memory', 'steps')]
+    return type(estimator).__name__, sorted(parameters,
+                                            key=lambda item: item[0])
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10
+
+
+class StageTrace:
+    """StageTrace
+    Timers of the stages of combined_notes and lr_cv. begin(name) starts a
+    stage (and ends the current one) and end() ends it: a JSON line is then
+    appended to the file 'path' with the name of the stage, the 'tags' of
+    the trace (disease, seed, period), the wall and CPU times in seconds,
+    the peak resident memory of the process at the end of the stage and
+    its increase during the stage in MB (0 when the stage stays below the
+    previous peak). The stage named 'profile_stage' is run under cProfile
+    and its statistics are saved in a .prof file next to the trace (read
+    with pstats), named after the stage and the tags. Nothing is measured
+    when 'path' is None. The lines of several processes can be appended to
+    the same file (see load_trace).
+    """
+
+    def __init__(self, path=None, profile_stage=None, **tags):
+        self.path = path
+        self.profile_stage = profile_stage
+        self.tags = tags
+        self.current = None
+        self.profiler = None
+
+    def tagged(self, **tags):
+        """New trace in the same file with additional tags."""
+        return StageTrace(self.path, self.profile_stage,
+                          **dict(self.tags, **tags))
+
+    def begin(self, name):
+        self.end()
+        if self.path is None:
+            return
+        if name == self.profile_stage:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.current = (name, time.time(), time.process_time(), peak_rss_mb())
+
+    def end(self):
+        if self.current is None:
+            return
+        name, start, start_cpu, start_peak = self.current
+        self.current = None
+        record = dict(stage=name, **self.tags, start=start,
+                      wall_time=time.time() - start,
+                      cpu_time=time.process_time() - start_cpu,
+                      peak_rss_mb=peak_rss_mb())
+        record['peak_rss_increase_mb'] = record['peak_rss_mb'] - start_peak
+        record['pid'] = os.getpid()
+        if self.profiler is not None:
+            self.profiler.disable()
+            record['profile'] = '_'.join(
+                [os.path.splitext(self.path)[0], name]
+                + [str(value) for value in self.tags.values()]) + '.prof'
+            self.profiler.dump_stats(record['profile'])
+            self.profiler = None
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # A single write of a line opened in append mode is not interleaved
+        # with the lines of the other processes.
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+def load_trace(path):
+    """DataFrame of the records of the StageTrace file 'path' (one row
+    per stage run)."""
+    return pd.read_json(path, lines=True)
 # ---------------------------------------------------------------------------
 
 
 # ---------------------------------------------------------------------------
-# FUNCTION TO PRE-PROCESS NOTES
+# FUNCTIONS AND CLASSES TO PRE-PROCESS NOTES
 # ---------------------------------------------------------------------------
+
+# Columns of the notes store read by NotesCorpus (plus the added features).
+store_columns = ['id', 'deid_notecontent', 'overallsurvival',
+                 'vitalstatusbinary', 'stage_grade', 'filingdate',
+                 'timefromdiagnostic', 'daysfromdiagnostic']
+
+
+def days_from_diagnostic(df_Notes):
+    """Number of days from 'dateofdiagnosis' to 'filingdate' of each note,
+    rounded up, so that a note is in the first 'period' days from diagnostic
+    when this number is <= period."""
+    return -((df_Notes['dateofdiagnosis'] - df_Notes['filingdate']
+              )//timedelta(days=1))
+
+
+def notes_to_parquet(disease, store='notes_store', df_Notes=None):
+    """This function converts the pickle df_Notes_{disease}.pkl (or the
+    dataframe 'df_Notes') into the partition {store}/disease={disease} of the
+    columnar notes store. The note time from diagnostic in years
+    ('timefromdiagnostic') and in days ('daysfromdiagnostic') are added and
+    'overallsurvival' is stored as float,
+    so that the filters of NotesCorpus can be applied by the Parquet reader.
+    An existing partition of the same disease is replaced."""
+
+    if df_Notes is None:
+        df_Notes = pd.read_pickle(f'df_Notes_{disease}.pkl')
+    df_Notes = df_Notes.copy()
+    df_Notes['overallsurvival'] = df_Notes['overallsurvival'].astype(float)
+    df_Notes['timefromdiagnostic'] = (df_Notes['filingdate'] -
+                                      df_Notes['dateofdiagnosis']
+                                      )/timedelta(days=365)
+    df_Notes['daysfromdiagnostic'] = days_from_diagnostic(df_Notes)
+
+    path = os.path.join(store, f'disease={disease}')
+    rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    pq.write_table(pa.Table.from_pandas(df_Notes, preserve_index=False),
+                   os.path.join(path, 'part-0.parquet'))
+    return path
+
+
+def read_notes_store(disease, store='notes_store', year_survival=5,
+                     days_sur_bounds=None, authortype_list=None,
+                     columns=None):
+    """This function reads the notes of 'disease' from the columnar notes
+    store. The filters of NotesCorpus (null notes, authors, notes between
+    diagnosis and 'overallsurvival', and the 'days_sur_bounds' window around
+    'year_survival') are pushed down to the reader, so only the qualifying
+    rows of the 'columns' (all the columns when None) are decoded. The notes
+    keep the order of the converted pickle."""
+
+    if days_sur_bounds is None:
+        days_sur_bounds = [10, 10]
+    time_from_diagnostic = ds.field('timefromdiagnostic')
+    overall_survival = ds.field('overallsurvival')
+    condition = ((ds.field('disease') == disease) &
+                 ds.field('deid_notecontent').is_valid() &
+                 (time_from_diagnostic >= 0) &
+                 (time_from_diagnostic <= overall_survival) &
+                 ((overall_survival <=
+                   year_survival -
+                   (timedelta(days=days_sur_bounds[0])/timedelta(days=365))) |
+                  (overall_survival >=
+                   year_survival +
+                   (timedelta(days=days_sur_bounds[1])/timedelta(days=365)))))
+    if authortype_list is not None:
+        condition &= ds.field('authortype').isin(authortype_list)
+
+    dataset = ds.dataset(store, format='parquet', partitioning='hive')
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != 'disease']
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+class NotesCorpus:
+    """NotesCorpus
+    In-memory notes of one disease. The pickle df_Notes_{disease}.pkl is read
+    once and the filters that do not depend on the period of analysis (null
+    notes, authors, notes between diagnosis and 'overallsurvival', and the
+    'days_sur_bounds' window around 'year_survival') are applied a single
+    time. The notes are sorted by 'id' and 'filingdate', so the same corpus
+    can be passed to combined_notes or lr_cv for every period and seed.
+    With 'store', the notes are read from the columnar notes store instead
+    (see notes_to_parquet) with the filters pushed down to the reader, and
+    only the columns used by combined_notes and 'added_features_list' are
+    decoded.
+    """
+
+    def __init__(self, disease, year_survival=5, days_sur_bounds=None,
+                 authortype_list=None, df_Notes=None, store=None,
+                 added_features_list=None):
+        if days_sur_bounds is None:
+            days_sur_bounds = [10, 10]
+        self.disease = disease
+        self.year_survival = year_survival
+        self.days_sur_bounds = list(days_sur_bounds)
+        self.authortype_list = authortype_list
+
+        if store is not None:
+            df_Notes = self.read_store(store, added_features_list)
+        else:
+            df_Notes = self.filter_notes(df_Notes)
+
+        # Order the notes by date (the sort is stable, so the notes of the
+        # same id and date keep the order of the input file).
+        df_Notes = df_Notes.sort_values(by=['id', 'filingdate'],
+                                        ascending=[True, True],
+                                        na_position='last', inplace=False)
+        df_Notes.reset_index(inplace=True, drop=True)
+        df_Notes['daysfromdiagnostic'] = df_Notes['daysfromdiagnostic'].astype(
+            np.int64)
+        self.df_Notes = df_Notes
+        self.timeline = PatientTimeline(df_Notes)
+        self.version_hash = None
+
+    def read_store(self, store, added_features_list=None):
+        """Read the notes of the corpus from the notes store, with the
+        filters applied by the reader."""
+        if added_features_list is None:
+            added_features_list = []
+        df_Notes = read_notes_store(self.disease, store=store,
+                                    year_survival=self.year_survival,
+                                    days_sur_bounds=self.days_sur_bounds,
+                                    authortype_list=self.authortype_list,
+                                    columns=store_columns + added_features_list)
+        df_Notes['vitalstatusbinary'] = df_Notes['vitalstatusbinary'].astype(int)
+        return df_Notes
+
+    def filter_notes(self, df_Notes=None):
+        """Load df_Notes_{disease}.pkl (when 'df_Notes' is None) and apply
+        the filters of the corpus."""
+        year_survival = self.year_survival
+        days_sur_bounds = self.days_sur_bounds
+        authortype_list = self.authortype_list
+
+        # Load all Notes.
+        if df_Notes is None:
+            df_Notes = pd.read_pickle(f'df_Notes_{self.disease}.pkl')
+
+        # Delete Null Notes.
+        df_Notes = df_Notes[~df_Notes['deid_notecontent'].isnull()].copy()
+        df_Notes.reset_index(inplace=True, drop=True)
+
+        # Delete duplicate notes.
+        del_duplicate = False
+        if del_duplicate:
+            df_Notes = custom_drop_duplicates(
+                df_Notes, colum_list=['deid_notecontent'])
+
+        df_Notes['overallsurvival'] = df_Notes['overallsurvival'].astype(float)
+        df_Notes['vitalstatusbinary'] = df_Notes['vitalstatusbinary'].astype(int)
+
+        # Select notes by author.
+        df_Notes = df_Notes[df_Notes['authortype'].isin(authortype_list)].copy()
+        df_Notes.reset_index(inplace=True, drop=True)
+
+        # Computing the note time from diagnostic in years.
+        df_Notes['timefromdiagnostic'] = (df_Notes['filingdate'] -
+                                          df_Notes['dateofdiagnosis']
+                                          )/timedelta(days=365)
+        df_Notes['daysfromdiagnostic'] = days_from_diagnostic(df_Notes)
+
+        # Select only after 'dateofdiagnosis' and before 'overallsurvival'
+        # This query also avoids taking patients with 'overallsurvival' in
+        # the center 'days_sur_bounds'.
+        df_Notes = df_Notes[((df_Notes['timefromdiagnostic'] >= 0) &
+                             (df_Notes['timefromdiagnostic'] <=
+                              df_Notes['overallsurvival'])) &
+                            ((df_Notes['overallsurvival'] <=
+                              year_survival -
+                              (timedelta(days=days_sur_bounds[0]
+                                         )/timedelta(days=365))) |
+                             (df_Notes['overallsurvival'] >=
+                              year_survival +
+                              (timedelta(days=days_sur_bounds[1]
+                                         )/timedelta(days=365))))]
+
+        return df_Notes
+
+    def version(self):
+        """Hash of the settings and the notes of the corpus (every column:
+        ids, dates, labels, stage/grade, added features and texts), which
+        identifies the corpus used to compute a result. The columns are
+        hashed one at a time and the texts note by note, so no copy of all
+        the texts is made."""
+        if self.version_hash is None:
+            digest = hashlib.md5(joblib_hash(
+                (self.disease, self.year_survival, self.days_sur_bounds,
+                 self.authortype_list)).encode())
+            for column in self.df_Notes.columns.drop('deid_notecontent'):
+                digest.update(joblib_hash(
+                    (column, self.df_Notes[column].values)).encode())
+            for note in self.df_Notes['deid_notecontent'].values:
+                note = note.encode('utf-8')
+                digest.update(len(note).to_bytes(8, 'little'))
+                digest.update(note)
+            self.version_hash = digest.hexdigest()
+        return self.version_hash
+
+    def release_texts(self):
+        """Drop the texts of the notes from df_Notes to free their memory
+        once they are in a NotesArena (see load_arena). The version is
+        computed first, as it hashes the texts. Afterwards, the corpus can
+        only be used with its arena (combined_notes and the building of an
+        arena need the texts)."""
+        self.version()
+        self.df_Notes.drop(columns='deid_notecontent', inplace=True,
+                           errors='ignore')
+
+    def check(self, year_survival, days_sur_bounds, authortype_list):
+        """Raise a ValueError if the corpus was filtered with other
+        settings than the ones requested ('authortype_list' None accepts
+        the corpus of any authors)."""
+        if days_sur_bounds is None:
+            days_sur_bounds = [10, 10]
+        if (self.year_survival != year_survival or
+                self.days_sur_bounds != list(days_sur_bounds) or
+                (authortype_list is not None and
+                 (self.authortype_list is None or
+                  list(self.authortype_list) != list(authortype_list)))):
+            raise ValueError(
+                f'The {self.disease} corpus was built with '
+                f'year_survival={self.year_survival}, '
+                f'days_sur_bounds={self.days_sur_bounds} and '
+                f'authortype_list={self.authortype_list}.')
+
+
+class PatientTimeline:
+    """PatientTimeline
+    Index of the notes of a NotesCorpus (ordered by 'id' and 'filingdate')
+    by patient: the code of the patient of each note ('id_codes'), the
+    positions of the first and last notes of each patient ('note_start',
+    'note_stop') and the integer days from diagnostic of the notes. When the
+    days of the notes of each patient are in order, the position of the
+    cutoff of a period for all the patients is a single searchsorted lookup.
+    """
+
+    def __init__(self, df_Notes):
+        self.id_codes, self.ids = pd.factorize(df_Notes['id'])
+        self.days = df_Notes['daysfromdiagnostic'].values
+        self.note_start = np.flatnonzero(np.diff(self.id_codes, prepend=-1))
+        self.note_stop = np.append(self.note_start[1:], len(self.id_codes))
+        self.is_sorted = (self.id_codes >= 0).all() and not np.any(
+            (self.id_codes[1:] == self.id_codes[:-1]) &
+            (self.days[1:] < self.days[:-1]))
+
+        # Keys of the notes ordered by patient and day.
+        self.span = int(self.days.max()) + 2 if len(self.days) else 1
+        self.keys = self.id_codes.astype(np.int64)*self.span + self.days
+
+    def cutoffs(self, period):
+        """Position after the last note of each patient in the first
+        'period' days from diagnostic (the days must be sorted)."""
+        period = min(max(int(np.floor(period)), -1), self.span - 1)
+        return np.searchsorted(
+            self.keys,
+            np.arange(len(self.ids), dtype=np.int64)*self.span + period,
+            side='right')
+
+    def select(self, period, minimun_number_of_notes=1):
+        """Mask of the notes in the first 'period' days from diagnostic of
+        the patients with at least 'minimun_number_of_notes' such notes, and
+        the number of these notes for each patient."""
+        if self.is_sorted:
+            stop = self.cutoffs(period)
+            id_count = stop - self.note_start
+            within = np.arange(len(self.id_codes)) < stop[self.id_codes]
+        else:
+            within = (self.days <= period) & (self.id_codes >= 0)
+            id_count = np.bincount(self.id_codes[within],
+                                   minlength=len(self.ids))
+        within &= id_count[self.id_codes] >= minimun_number_of_notes
+        return within, id_count
+
+
+def load_corpus(disease, year_survival=5, days_sur_bounds=None,
+                authortype_list=None):
+    """Return 'disease' if it is already a NotesCorpus built with the same
+    settings, otherwise load the NotesCorpus of df_Notes_{disease}.pkl."""
+    if isinstance(disease, NotesCorpus):
+        disease.check(year_survival, days_sur_bounds, authortype_list)
+        return disease
+    return NotesCorpus(disease, year_survival=year_survival,
+                       days_sur_bounds=days_sur_bounds,
+                       authortype_list=authortype_list)
+
+
+class NotesArena:
+    """NotesArena
+    Notes of a NotesCorpus stored in the folder 'path' (see load_arena) and
+    memory-mapped: the token ids of all the notes (tokenize_documents) in a
+    single array, in the order of the corpus, with the offsets of the token
+    ids and of the characters of each note. The note positions given to text_length and documents are positions in
+    'order' (array of the corpus positions of the notes, None for the order
+    of the corpus), in which the notes concatenated by iter_combined_notes
+    are consecutive. The documents of notes that are also consecutive in the
+    corpus are slices of the token ids, so no Python string is created per
+    note or per patient.
+    """
+
+    def __init__(self, path, order=None):
+        self.path = path
+        self.order = order
+        self.char_offsets = np.load(os.path.join(path, 'char_offsets.npy'),
+                                    mmap_mode='r')
+        self.token_offsets = np.load(os.path.join(path, 'token_offsets.npy'),
+                                     mmap_mode='r')
+        self.tokens = np.load(os.path.join(path, 'tokens.npy'),
+                              mmap_mode='r')
+        self.terms = np.load(os.path.join(path, 'terms.npy'),
+                             allow_pickle=True)
+
+        # Character offsets of the notes in 'order'.
+        self.order_char_offsets = self.char_offsets
+        if order is not None:
+            self.order_char_offsets = np.concatenate([[0], np.cumsum(
+                np.diff(self.char_offsets)[order])])
+
+    def __len__(self):
+        return len(self.token_offsets) - 1
+
+    def __reduce__(self):
+        # The worker processes map the same files.
+        return NotesArena, (self.path, self.order)
+
+    def text_length(self, start, stop):
+        """Number of characters of the concatenated texts of the arrays of
+        note positions 'start' and 'stop'."""
+        return np.maximum(np.asarray(self.order_char_offsets[stop]) -
+                          np.asarray(self.order_char_offsets[start]) - 1, 0)
+
+    def documents(self, start, stop):
+        """Series with the token ids of the concatenated texts of the arrays
+        of note positions 'start' and 'stop' (views of the mapped ids when
+        the notes are consecutive in the corpus, copies otherwise)."""
+        documents = np.empty(len(start), dtype=object)
+        for i, (a, b) in enumerate(zip(start, stop)):
+            if self.order is not None:
+                notes = self.order[a:b]
+                if b - a > 1 and np.any(np.diff(notes) != 1):
+                    documents[i] = np.concatenate(
+                        [self.tokens[self.token_offsets[note]:
+                                     self.token_offsets[note + 1]]
+                         for note in notes])
+                    continue
+                if b > a:
+                    a, b = notes[0], notes[0] + b - a
+            documents[i] = self.tokens[self.token_offsets[a]:
+                                       self.token_offsets[b]]
+        return pd.Series(documents)
+
+
+def notes_order(df_Notes, added_features_list=None):
+    """Order of the notes of a corpus in which the notes of each group of
+    combined_notes (same 'id', 'overallsurvival', 'vitalstatusbinary',
+    'stage_grade' and added features) are consecutive and sorted by day from
+    diagnostic (None when it is the order of the corpus). It returns the
+    order and the group code of each note (-1 for the notes with a missing
+    key)."""
+    if added_features_list is None:
+        added_features_list = []
+    group_codes = df_Notes.groupby(['id', 'overallsurvival',
+                                    'vitalstatusbinary', 'stage_grade'] +
+                                   added_features_list, sort=True).ngroup()
+    group_codes = group_codes.fillna(-1).values.astype(np.int64)
+    order = np.lexsort((df_Notes['daysfromdiagnostic'].values, group_codes))
+    if np.array_equal(order, np.arange(len(order))):
+        order = None
+    return order, group_codes
+
+
+def load_arena(corpus, path, added_features_list=None):
+    """Return the NotesArena of 'corpus' in the folder 'path', with the
+    order of the groups of 'added_features_list' (see notes_order). The
+    arena is (re)built from the texts of corpus.df_Notes when the folder
+    does not contain the notes of this corpus. The corpus is not modified
+    (NotesCorpus.release_texts frees the texts once the arena is loaded)."""
+
+    df_Notes = corpus.df_Notes
+    order = notes_order(df_Notes, added_features_list)[0]
+    key = corpus.version()
+    key_file = os.path.join(path, 'key.txt')
+    if os.path.exists(key_file):
+        with open(key_file) as f:
+            if f.read() == key:
+                return NotesArena(path, order)
+    if 'deid_notecontent' not in df_Notes:
+        raise ValueError(f'The texts of the {corpus.disease} corpus were '
+                         f'released, the arena {path} cannot be built.')
+
+    rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    notes = df_Notes['deid_notecontent'].tolist()
+
+    # Character offsets of the notes (each note is followed by the space that
+    # separates the concatenated notes).
+    np.save(os.path.join(path, 'char_offsets.npy'),
+            np.concatenate([[0], np.cumsum(
+                df_Notes['deid_notecontent'].str.len().values + 1)]))
+
+    # Token ids of each note.
+    documents, terms = tokenize_documents(notes)
+    del notes
+    np.save(os.path.join(path, 'token_offsets.npy'),
+            np.concatenate([[0], np.cumsum(documents.map(len).values)]))
+    np.save(os.path.join(path, 'tokens.npy'),
+            np.concatenate(documents.tolist()) if len(documents)
+            else np.array([], dtype=np.int32))
+    np.save(os.path.join(path, 'terms.npy'), terms, allow_pickle=True)
+    del documents
+
+    with open(key_file, 'w') as f:
+        f.write(key)
+    return NotesArena(path, order)
+
+
 def combined_notes(disease, period=60, year_survival=5, days_sur_bounds=None,
                    authortype_list=None, idlist=None,
-                   added_features_list=None):
+                   added_features_list=None, trace=None):
     """
     This function chronologically concatenates all the notes of the same id in
     a single text.
@@ -206,6 +870,8 @@ def combined_notes(disease, period=60, year_survival=5, days_sur_bounds=None,
      disease: 
          Name of the disease in the pickle object name df_Notes_{disease}.pkl 
          Ex. disease = 'breast' refers to the pickle df_Notes_breast.pkl    
+         or a NotesCorpus already loaded with the same 'year_survival',
+         'days_sur_bounds' and 'authortype_list'.
      period:
          Number of days after diagnosis considered to select the notes.
      year_survival:
@@ -219,6 +885,9 @@ def combined_notes(disease, period=60, year_survival=5, days_sur_bounds=None,
          List of id considered.
      added_features_list:
          Features from the input working data set conserved in the output.
+     trace:
+         StageTrace where the stage 'combined_notes' is timed (tagged with
+         the period).
 
     Return
     ------
@@ -226,89 +895,55 @@ def combined_notes(disease, period=60, year_survival=5, days_sur_bounds=None,
         Dataframe with concatenated notes and other information related with
         the id and text.
     """
-    # Load all Notes.
-    df_Notes = pd.read_pickle(f'df_Notes_{disease}.pkl')
-
-    # Delete Null Notes.
-    df_Notes = df_Notes[~df_Notes['deid_notecontent'].isnull()].copy()
-    df_Notes.reset_index(inplace=True, drop=True)
-
-    # Delete duplicate notes.
-    del_duplicate = False
-    if del_duplicate:
-        df_Notes = custom_drop_duplicates(
-            df_Notes, colum_list=['deid_notecontent'])
-
-    df_Notes['overallsurvival'] = df_Notes['overallsurvival'].astype(float)
-    df_Notes['vitalstatusbinary'] = df_Notes['vitalstatusbinary'].astype(int)
-
-    # Select notes by author.
-    df_Notes = df_Notes[df_Notes['authortype'].isin(authortype_list)].copy()
-    df_Notes.reset_index(inplace=True, drop=True)
-
-    # Computing the note time from diagnostic in years.
-    df_Notes['timefromdiagnostic'] = (df_Notes['filingdate'] -
-                                      df_Notes['dateofdiagnosis']
-                                      )/timedelta(days=365)
-
-    # Select only after 'dateofdiagnosis' and before 'overallsurvival'
-    # This query also avoids taking patients with 'overallsurvival' in 
-    # the center 'days_sur_bounds'.
-    if days_sur_bounds is None:
-        days_sur_bounds = [10, 10]
-
-    df_Notes = df_Notes[((df_Notes['timefromdiagnostic'] >= 0) &
-                         (df_Notes['timefromdiagnostic'] <=
-                          df_Notes['overallsurvival'])) &
-                        ((df_Notes['overallsurvival'] <=
-                          year_survival -
-                          (timedelta(days=days_sur_bounds[0]
-                                     )/timedelta(days=365))) |
-                         (df_Notes['overallsurvival'] >=
-                          year_survival +
-                          (timedelta(days=days_sur_bounds[1]
-                                     )/timedelta(days=365))))].copy()
-    df_Notes.reset_index(inplace=True, drop=True)
-
-    # Select only the notes of the first 'x' years from diagnostic.
-    df_Notes = df_Notes[df_Notes['timefromdiagnostic'] <=
-                        timedelta(days=period)/timedelta(days=365)].copy()
-    df_Notes.reset_index(inplace=True, drop=True)
+    trace = (StageTrace() if trace is None else trace).tagged(period=period)
+    trace.begin('combined_notes')
+    corpus = load_corpus(disease, year_survival=year_survival,
+                         days_sur_bounds=days_sur_bounds,
+                         authortype_list=authortype_list)
+    timeline = corpus.timeline
+    if added_features_list is None:
+        added_features_list = []
 
-    # Number of notes by id.
+    # Number of notes by id in the first 'period' days from diagnostic.
     minimun_number_of_notes = 3
     compute_number_of_notes = False  # True when use quartiles.
     if compute_number_of_notes:
-        df_index = (df_Notes['id'].value_counts()).to_frame()[
-            'id'].describe().to_frame()
-        minimun_number_of_notes = df_index[df_index.index.str.startswith(
-            '25%')].iloc[0][0].astype(int)
-
-    # Select only id with more than 'minimun_number_of_notes'.
-    cols = ['id']
-    df_Notes['id_count'] = df_Notes.groupby(cols)['id'].transform('size')
-    df_Notes = df_Notes[df_Notes['id_count']
-                        >= minimun_number_of_notes].copy()
-    df_Notes.reset_index(inplace=True, drop=True)
-
-    # Order the notes by date.
-    df_Notes = df_Notes.sort_values(by=['id', 'filingdate'],
-                                    ascending=[True, True], na_position='last',
-                                    inplace=False)
-    df_Notes.reset_index(inplace=True, drop=True)
+        id_count = timeline.select(period)[1]
+        minimun_number_of_notes = pd.Series(
+            id_count[id_count > 0]).describe()['25%'].astype(int)
+
+    # Select only the notes of the first 'period' days from diagnostic of the
+    # ids with more than 'minimun_number_of_notes' (one lookup in the
+    # timeline of the corpus).
+    selected, id_count = timeline.select(period, minimun_number_of_notes)
+    df_Notes = corpus.df_Notes.loc[selected, ['id', 'overallsurvival',
+                                              'vitalstatusbinary',
+                                              'stage_grade'] +
+                                   added_features_list + ['deid_notecontent']]
+    df_Notes['id_count'] = id_count[timeline.id_codes[selected]]
+
+    # The notes are already ordered by date in the corpus.
 
     # Concatenate all notes by id.
-    if added_features_list is None:
-        added_features_list = []
-
-    
     df_Notes = df_Notes.groupby(['id', 'overallsurvival','vitalstatusbinary','stage_grade','id_count']+added_features_list,
                                 )['deid_notecontent'].apply(' '.join).reset_index(drop=False, inplace=False)
     
     df_Notes.rename(columns={df_Notes.columns[-1]: 'text'}, inplace=True)
     
-    # Add length.
-    df_Notes['text_length'] = df_Notes['text'].str.len()
+    df_Notes = label_notes(df_Notes, year_survival=year_survival,
+                           idlist=idlist)
+    trace.end()
+    return df_Notes
+
+
+def label_notes(df_Notes, year_survival=5, idlist=None):
+    """This function adds the length of the concatenated text and the
+    survival label to the output of the concatenation, and keeps the ids in
+    'idlist' only (when it is given)."""
+
+    # Add length (already computed from the offsets of a NotesArena).
+    if 'text_length' not in df_Notes:
+        df_Notes['text_length'] = df_Notes['text'].str.len()
     
     # Computing the label.
     df_Notes['label'] = None
@@ -336,6 +971,152 @@ def combined_notes(disease, period=60, year_survival=5, days_sur_bounds=None,
 
 
     return df_Notes
+
+def iter_combined_notes(disease, periods, year_survival=5, days_sur_bounds=None,
+                        authortype_list=None, added_features_list=None,
+                        arena=None, trace=None):
+    """
+    Generator version of combined_notes for a list of periods. The notes are
+    swept once in the order of the cutoffs and, for each id, only the notes
+    that are new since the previous cutoff are appended to the text. For
+    each period, it yields (period, df_Notes) with the same dataframe that
+    combined_notes(disease, period, ...) returns.
+
+    Parameters
+    ----------
+     disease:
+         Name of the disease (df_Notes_{disease}.pkl) or a NotesCorpus.
+     periods:
+         List of number of days after diagnosis considered to select the
+         notes, in increasing order.
+     year_survival, days_sur_bounds, authortype_list, added_features_list:
+         Same as in combined_notes.
+     arena:
+         NotesArena of the corpus loaded with the same 'added_features_list'
+         (see load_arena). When it is given, the 'text' column is replaced by
+         the positions 'note_start' and 'note_stop' of the concatenated notes
+         in the order of the arena, where the notes of each group are sorted
+         by day from diagnostic (the order of the corpus when the days of
+         each id are in order).
+     trace:
+         StageTrace where the grouping of the notes ('group_notes') and the
+         texts of each period ('combined_notes') are timed.
+    """
+    if trace is None:
+        trace = StageTrace()
+    trace.begin('group_notes')
+    corpus = load_corpus(disease, year_survival=year_survival,
+                         days_sur_bounds=days_sur_bounds,
+                         authortype_list=authortype_list)
+    if added_features_list is None:
+        added_features_list = []
+    periods = list(periods)
+    if arena is not None and periods != sorted(periods):
+        # The arena positions are swept in the order of the cutoffs.
+        trace.end()
+        notes_by_period = dict(iter_combined_notes(
+            corpus, sorted(set(periods)), year_survival=year_survival,
+            days_sur_bounds=days_sur_bounds, authortype_list=authortype_list,
+            added_features_list=added_features_list, arena=arena,
+            trace=trace))
+        for period in periods:
+            yield period, notes_by_period[period]
+        return
+    key_cols = ['id', 'overallsurvival', 'vitalstatusbinary',
+                'stage_grade'] + added_features_list
+    minimun_number_of_notes = 3
+
+    df_Notes = corpus.df_Notes
+
+    # Index of the first period that includes each note.
+    note_step = np.searchsorted(np.asarray(periods),
+                                df_Notes['daysfromdiagnostic'].values,
+                                side='left')
+    in_window = note_step < len(periods)
+    id_codes, id_values = corpus.timeline.id_codes, corpus.timeline.ids
+    order, group_codes = notes_order(df_Notes, added_features_list)
+    if arena is not None and (
+            len(arena) != len(df_Notes) or (order is None) !=
+            (arena.order is None) or (order is not None and
+                                      not np.array_equal(order, arena.order))):
+        raise ValueError('The NotesArena was not loaded for this corpus and '
+                         'added_features_list.')
+
+    # The sweep needs the cutoffs in order and, for the texts, the new notes
+    # of an id to come after the ones already included (same
+    # 'dateofdiagnosis' for each id). The notes of each group of the arena are
+    # sorted by day.
+    step_order = np.where(in_window, note_step, len(periods))
+    is_sweepable = arena is not None or (
+        periods == sorted(periods) and
+        not np.any((id_codes[1:] == id_codes[:-1]) &
+                   (step_order[1:] < step_order[:-1])))
+    if not is_sweepable:
+        trace.end()
+        for period in periods:
+            yield period, combined_notes(
+                corpus, period=period, year_survival=year_survival,
+                days_sur_bounds=days_sur_bounds,
+                authortype_list=authortype_list,
+                added_features_list=added_features_list, trace=trace)
+        return
+
+    # Values of the keys of each group.
+    _, group_first = np.unique(group_codes[group_codes >= 0],
+                               return_index=True)
+    group_first = np.flatnonzero(group_codes >= 0)[group_first]
+    df_keys = df_Notes.loc[group_first, key_cols]
+    df_keys.reset_index(inplace=True, drop=True)
+    group_id_codes = id_codes[group_first]
+    if arena is not None:
+        # Position of the first note of each group in the arena.
+        group_first = np.searchsorted(
+            group_codes if order is None else group_codes[order],
+            np.arange(len(df_keys)))
+
+    id_count = np.zeros(len(id_values), dtype=np.int64)
+    text = np.full(len(df_keys), None, dtype=object)
+    has_text = np.zeros(len(df_keys), dtype=bool)
+    group_notes = np.zeros(len(df_keys), dtype=np.int64)
+    trace.end()
+
+    for k, period in enumerate(periods):
+        period_trace = trace.tagged(period=period)
+        period_trace.begin('combined_notes')
+        new_notes = note_step == k
+        np.add.at(id_count, id_codes[new_notes], 1)
+
+        # Append only the new notes to the text of each group.
+        new_notes &= group_codes >= 0
+        if arena is not None:
+            np.add.at(group_notes, group_codes[new_notes], 1)
+            has_text = group_notes > 0
+        elif new_notes.any():
+            new_text = df_Notes['deid_notecontent'][new_notes].groupby(
+                group_codes[new_notes], sort=False).apply(' '.join)
+            for g, text_g in zip(new_text.index, new_text.values):
+                text[g] = text[g] + ' ' + text_g if has_text[g] else text_g
+            has_text[new_text.index.values] = True
+
+        # Select only id with more than 'minimun_number_of_notes'.
+        group_count = id_count[group_id_codes]
+        selected = (group_count >= minimun_number_of_notes) & has_text
+        df_period = df_keys[selected].copy()
+        df_period.insert(len(key_cols) - len(added_features_list),
+                         'id_count', group_count[selected])
+        if arena is None:
+            df_period['text'] = text[selected]
+        else:
+            df_period['note_start'] = group_first[selected]
+            df_period['note_stop'] = (group_first[selected] +
+                                      group_notes[selected])
+            df_period['text_length'] = arena.text_length(
+                df_period['note_start'].values, df_period['note_stop'].values)
+        df_period.reset_index(inplace=True, drop=True)
+        df_period = label_notes(df_period, year_survival=year_survival)
+        period_trace.end()
+
+        yield period, df_period
 # ---------------------------------------------------------------------------
 
 
@@ -347,9 +1128,762 @@ re_tok = re.compile(f'([{string.punctuation}“”¨«»®´·º½¾¿¡§£₤
 def tokenize(s): return re_tok.sub(r' \1 ', s).split()
 
 
+def tokenize_documents(texts):
+    """This function tokenizes each document once, with the same analyzer as
+    TfidfVectorizer(tokenizer=tokenize, strip_accents='unicode'), and returns
+    (documents, terms): a Series with the token ids of each document and
+    the array of terms. The ids follow the alphabetical order of the terms,
+    which is the column order of TfidfVectorizer."""
+
+    analyzer = TfidfVectorizer(tokenizer=tokenize,
+                               strip_accents='unicode').build_analyzer()
+    vocabulary = {}
+    documents = np.empty(len(texts), dtype=object)
+    for i, text in enumerate(texts):
+        documents[i] = np.array([vocabulary.setdefault(token, len(vocabulary))
+                                 for token in analyzer(text)], dtype=np.int32)
+
+    # Renumber the ids in the alphabetical order of the terms.
+    terms = np.array(list(vocabulary), dtype=object)
+    order = np.argsort(terms)
+    new_ids = np.empty(len(terms), dtype=np.int32)
+    new_ids[order] = np.arange(len(terms), dtype=np.int32)
+    for i, document in enumerate(documents):
+        documents[i] = new_ids[document]
+
+    return pd.Series(documents), terms[order]
+
+
+class TokenTfidfVectorizer(BaseEstimator, TransformerMixin):
+    """TokenTfidfVectorizer
+    Variation of TfidfVectorizer (unigrams) that counts the token ids of
+    tokenize_documents instead of tokenizing raw strings. The document
+    frequency limits (min_df, max_df, max_features) and the tf-idf weights
+    are the same as TfidfVectorizer. The ids of the selected terms are kept
+    in 'token_ids_'.
+    """
+
+    def __init__(self, min_df=1, max_df=1.0, max_features=None, norm='l2',
+                 use_idf=True, smooth_idf=True, sublinear_tf=False):
+        self.min_df = min_df
+        self.max_df = max_df
+        self.max_features = max_features
+        self.norm = norm
+        self.use_idf = use_idf
+        self.smooth_idf = smooth_idf
+        self.sublinear_tf = sublinear_tf
+
+    def column_ids(self, ids):
+        """Column ids of the token ids 'ids' (the token ids themselves)."""
+        return ids
+
+    def feature_names(self, terms, columns):
+        """Terms of the selected columns 'columns' (indexes in
+        'token_ids_'), where 'terms' are the terms of the token ids."""
+        return terms[self.token_ids_[columns]].tolist()
+
+    def count(self, documents, token_ids):
+        """Document-term count matrix of 'documents' with the columns
+        'token_ids' (sorted). Ids out of 'token_ids' are ignored."""
+        lengths = np.array([len(document) for document in documents],
+                           dtype=np.int64)
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        ids = self.column_ids(np.concatenate(list(documents)) if len(documents)
+                              else np.array([], dtype=np.int32))
+        columns = np.searchsorted(token_ids, ids)
+        columns[columns == len(token_ids)] = 0
+        data = (token_ids[columns] == ids).astype(np.int64) if len(
+            token_ids) else np.zeros(len(ids), dtype=np.int64)
+        X = sp.csr_matrix((data, columns, indptr),
+                          shape=(len(documents), len(token_ids)))
+        X.sum_duplicates()
+        X.eliminate_zeros()
+        return X
+
+    def limit_features(self, X):
+        """Mask of the columns of X kept by min_df, max_df and max_features
+        (same rule as CountVectorizer, the terms absent from X are removed)."""
+        n_doc = X.shape[0]
+        max_doc_count = (self.max_df if isinstance(self.max_df, int)
+                         else self.max_df * n_doc)
+        min_doc_count = (self.min_df if isinstance(self.min_df, int)
+                         else self.min_df * n_doc)
+        if max_doc_count < min_doc_count:
+            raise ValueError(
+                "max_df corresponds to < documents than min_df")
+        dfs = np.bincount(X.indices, minlength=X.shape[1])
+        mask = (dfs > 0) & (dfs <= max_doc_count) & (dfs >= min_doc_count)
+        if self.max_features is not None and mask.sum() > self.max_features:
+            tfs = np.asarray(X.sum(axis=0)).ravel()
+            mask_inds = (-tfs[mask]).argsort()[:self.max_features]
+            new_mask = np.zeros(len(dfs), dtype=bool)
+            new_mask[np.where(mask)[0][mask_inds]] = True
+            mask = new_mask
+        if not mask.any():
+            raise ValueError("After pruning, no terms remain. Try a lower"
+                             " min_df or a higher max_df.")
+        return mask
+
+    def fit_transform_counts(self, X, token_ids):
+        """fit_transform from the count matrix X with the columns
+        'token_ids'."""
+        mask = self.limit_features(X)
+        self.token_ids_ = token_ids[mask]
+        X = X[:, np.where(mask)[0]]
+        self.tfidf_ = TfidfTransformer(norm=self.norm,
+                                       use_idf=self.use_idf,
+                                       smooth_idf=self.smooth_idf,
+                                       sublinear_tf=self.sublinear_tf).fit(X)
+        return self.tfidf_.transform(X, copy=False)
+
+    def transform_counts(self, X, token_ids):
+        """transform from the count matrix X with the columns 'token_ids'
+        (which include 'token_ids_')."""
+        columns = np.searchsorted(token_ids, self.token_ids_)
+        return self.tfidf_.transform(X[:, columns], copy=False)
+
+    def fit_transform(self, documents, y=None):
+        token_ids = np.unique(self.column_ids(np.concatenate(list(documents))))
+        return self.fit_transform_counts(self.count(documents, token_ids),
+                                         token_ids)
+
+    def fit(self, documents, y=None):
+        self.fit_transform(documents)
+        return self
+
+    def transform(self, documents):
+        X = self.count(documents, self.token_ids_)
+        return self.tfidf_.transform(X, copy=False)
+
+
+def hash_terms(terms, n_features=2**20):
+    """Column of each term in HashingVectorizer(n_features=n_features)
+    (signed 32 bit MurmurHash3 of the UTF-8 term, seed 0)."""
+    hashes = np.array([murmurhash3_32(term, seed=0) for term in terms],
+                      dtype=np.int64)
+    buckets = np.abs(hashes) % n_features
+    buckets[hashes == -2**31] = (2**31 - 1 - (n_features - 1)) % n_features
+    return buckets
+
+
+class HashingTfidfVectorizer(TokenTfidfVectorizer):
+    """HashingTfidfVectorizer
+    Variation of TokenTfidfVectorizer where the columns are the hashed
+    buckets of the terms ('buckets' has the bucket of each token id, see
+    hash_terms) instead of the terms, so the columns do not depend on the
+    vocabulary of the notes. The document frequency limits and the idf
+    weights are computed from the hashed counts and the selected buckets
+    are kept in 'token_ids_'. fit also keeps the sparse map 'reverse_map_'
+    (selected buckets x token ids) of the training terms of each bucket,
+    used to name the features.
+    """
+
+    def __init__(self, buckets=None, min_df=1, max_df=1.0, max_features=None,
+                 norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=False):
+        super().__init__(min_df=min_df, max_df=max_df,
+                         max_features=max_features, norm=norm,
+                         use_idf=use_idf, smooth_idf=smooth_idf,
+                         sublinear_tf=sublinear_tf)
+        self.buckets = buckets
+
+    def column_ids(self, ids):
+        """Buckets of the token ids 'ids'."""
+        return self.buckets[ids]
+
+    def feature_names(self, terms, columns):
+        """Names of the selected buckets 'columns' (indexes in
+        'token_ids_'): the training terms of each bucket joined by '|'."""
+        return ['|'.join(terms[self.reverse_map_[column].indices])
+                for column in columns]
+
+    def fit_transform(self, documents, y=None):
+        X = super().fit_transform(documents, y)
+        ids = np.unique(np.concatenate(list(documents)))
+        rows = np.searchsorted(self.token_ids_, self.buckets[ids])
+        rows[rows == len(self.token_ids_)] = 0
+        kept = self.token_ids_[rows] == self.buckets[ids]
+        self.reverse_map_ = sp.csr_matrix(
+            (np.ones(kept.sum(), dtype=bool), (rows[kept], ids[kept])),
+            shape=(len(self.token_ids_), len(self.buckets)))
+        return X
+
+
+def oversampling_weights(y, random_state=None):
+    """Number of times each row of the labels 'y' is drawn by
+    RandomOverSampler(random_state=random_state) (the draws only depend on
+    the labels)."""
+    sampler = RandomOverSampler(random_state=random_state)
+    sampler.fit_resample(np.zeros((len(y), 1)), y)
+    return np.bincount(sampler.sample_indices_,
+                       minlength=len(y)).astype(np.float64)
+
+
+class OverSampledLogisticRegression(LogisticRegression):
+    """OverSampledLogisticRegression
+    LogisticRegression fitted with the class balance of
+    RandomOverSampler(random_state=random_state) without copying the rows of
+    X: the oversampler draws the same indices from the labels only, and each
+    training row is weighted by the number of times it is drawn (the loss is
+    the one of the oversampled copies).
+    """
+
+    def fit(self, X, y, sample_weight=None):
+        y = np.asarray(y)
+        weights = oversampling_weights(y, self.random_state)
+        if sample_weight is not None:
+            weights *= sample_weight
+        return super().fit(X, y, sample_weight=weights)
+
+
+def oversampled_lr_steps(random_state=17, oversampling='rows', C=1.0):
+    """This function returns the last steps of the lr_cv pipelines: the
+    oversampling of the minority class followed by LogisticRegression.
+
+    Parameters
+    ----------
+     random_state:
+         Seed used by the random number generator.
+     oversampling:
+         'rows' (RandomOverSampler copies the minority rows) or 'weights'
+         (OverSampledLogisticRegression, same draws as sample weights).
+     C:
+         Inverse of regularization strength of LogisticRegression.
+    """
+    if oversampling == 'weights':
+        return [('logisticregression',
+                 OverSampledLogisticRegression(random_state=random_state,
+                                               C=C))]
+    return [('randomOversampler',
+             RandomOverSampler(random_state=random_state)),
+            ('logisticregression',
+             LogisticRegression(random_state=random_state, C=C))]
+
+
+def search_cv_results(candidates, scores):
+    """This function summarizes the fold scores of a hyperparameter search in
+    the same way as GridSearchCV with refit='f1'. 'scores' maps each scoring
+    name to an array (n_candidates, n_splits). It returns the cv_results_
+    dictionary and the best index."""
+
+    results = {'params': candidates}
+    for name, array in scores.items():
+        array = np.asarray(array, dtype=np.float64)
+        array_means = np.average(array, axis=1)
+        results[f'mean_test_{name}'] = array_means
+        results[f'std_test_{name}'] = np.sqrt(
+            np.average((array - array_means[:, np.newaxis])**2, axis=1))
+        if np.isnan(array_means).all():
+            rank = np.ones_like(array_means, dtype=np.int32)
+        else:
+            array_means = np.nan_to_num(array_means,
+                                        nan=np.nanmin(array_means) - 1)
+            rank = rankdata(-array_means, method='min').astype(np.int32)
+        results[f'rank_test_{name}'] = rank
+
+    return results, int(results['rank_test_f1'].argmin())
+
+
+class SearchResult:
+    """SearchResult
+    cv_results_ (scores), best_index_ and best_params_ of a fitted
+    hyperparameter search (GridSearchCV, CountsSearchCV or PathSearchCV),
+    without the fitted estimators, so it can be memoized.
+    """
+
+    def __init__(self, search):
+        self.cv_results_ = {name: values
+                            for name, values in search.cv_results_.items()
+                            if name == 'params' or
+                            name.startswith(('mean_test_', 'std_test_',
+                                             'rank_test_'))}
+        self.best_index_ = search.best_index_
+        self.best_params_ = search.best_params_
+
+
+def fit_search(search, X, y, memo=None, key=None):
+    """Fit the hyperparameter search 'search' on (X, y) and return its
+    SearchResult, memoized under 'key' in the FitMemo 'memo'."""
+    return memoize(memo, key, lambda: SearchResult(search.fit(X, y)))
+
+
+def score_predictions(y_true, y_pred):
+    """Scores of lr_cv (F1 macro and AUC of the predicted labels)."""
+    try:
+        auc = roc_auc_score(y_true, y_pred)
+    except ValueError:
+        auc = np.nan
+    return f1_score(y_true, y_pred, average='macro'), auc
+
+
+def group_candidates(candidates):
+    """Lists of the indexes of the candidates that only differ by the
+    parameters of the 'logisticregression' step."""
+    groups = {}
+    for k, candidate in enumerate(candidates):
+        key = tuple(sorted((name, value) for name, value in candidate.items()
+                           if not name.startswith('logisticregression__')))
+        groups.setdefault(key, []).append(k)
+    return list(groups.values())
+
+
+def score_candidates(estimator, candidates, group, X_train, y_train, X_test,
+                     y_test, warm_start=False):
+    """This function fits the LogisticRegression step of the candidates in
+    'group' on the preprocessed fold (X_train, y_train) and returns a
+    dictionary {candidate index: (f1, auc)} on (X_test, y_test). With
+    'warm_start', the candidates are fitted in increasing order of C and
+    each fit starts from the coefficients of the previous one."""
+    scores = {}
+    if warm_start:
+        group = sorted(group,
+                       key=lambda k: candidates[k]['logisticregression__C'])
+    clf = None
+    for k in group:
+        if clf is None or not warm_start:
+            clf = clone(estimator).set_params(
+                **candidates[k])['logisticregression']
+            clf.set_params(warm_start=warm_start)
+        else:
+            clf.set_params(C=candidates[k]['logisticregression__C'])
+        clf.fit(X_train, y_train)
+        scores[k] = score_predictions(y_test, clf.predict(X_test))
+    return scores
+
+
+def score_counts_fold(estimator, candidates, group, X, token_ids, y,
+                      i_train, i_test, warm_start=False):
+    """This function scores the candidates in 'group' (same vocabulary) on
+    one fold of CountsSearchCV. The tf-idf weights and the oversampling are
+    computed from the rows 'i_train' of the count matrix X (columns
+    'token_ids') and the LogisticRegression step of each candidate is
+    evaluated on the rows 'i_test'. It returns the dictionary of
+    score_candidates."""
+    pipeline = clone(estimator).set_params(**candidates[group[0]])
+    X_train_tfidf = pipeline['tfidfvectorizer'].fit_transform_counts(
+        X[i_train], token_ids)
+    X_test_tfidf = pipeline['tfidfvectorizer'].transform_counts(
+        X[i_test], token_ids)
+    y_train = y[i_train]
+    if 'randomOversampler' in pipeline.named_steps:
+        X_res, y_res = pipeline['randomOversampler'].fit_resample(
+            X_train_tfidf, y_train)
+    else:
+        X_res, y_res = X_train_tfidf, y_train
+    return score_candidates(estimator, candidates, group, X_res, y_res,
+                            X_test_tfidf, y[i_test], warm_start=warm_start)
+
+
+def score_counts_fold_job(path, estimator, candidates, group, i_train,
+                          i_test, warm_start=False):
+    """Job of the worker processes of CountsSearchCV: score_counts_fold with
+    the count matrix, token ids and labels memory-mapped from the joblib
+    file 'path' (read-only, the pages are shared by all the workers)."""
+    X, token_ids, y = load(path, mmap_mode='r')
+    return score_counts_fold(estimator, candidates, group, X, token_ids, y,
+                             i_train, i_test, warm_start=warm_start)
+
+
+class CountsSearchCV:
+    """CountsSearchCV
+    Grid search of the TokenTfidfVectorizer + RandomOverSampler +
+    LogisticRegression (or OverSampledLogisticRegression) pipeline of lr_cv
+    that gives the same cv_results_,
+    best_index_ and best_params_ as GridSearchCV(refit='f1'). The
+    document-term counts are computed once, each fold selects its rows, and
+    the vocabulary of every 'tfidfvectorizer__max_features' value is a column
+    selection of the fold counts. The tf-idf weights and the oversampling are
+    computed once per fold and vocabulary, so only LogisticRegression is
+    fitted for each candidate. With 'warm_start', the C values are fitted in
+    increasing order, each fit starting from the previous coefficients (the
+    scores then agree with GridSearchCV up to the solver tolerance).
+
+    With n_jobs > 1, the fold x vocabulary jobs run in a pool of worker
+    processes. The count matrix is saved once in a joblib file of
+    'temp_folder' and memory-mapped by the workers, which only receive the
+    fold indexes and the candidates, so the documents are never copied to
+    the workers.
+
+    With a FitMemo 'memo', the scores of each fold x vocabulary job are
+    memoized under 'memo_key', the patient 'ids' of the training and
+    validation rows of the fold and the parameters of the candidates, and
+    only the missing jobs are computed.
+    """
+
+    def __init__(self, estimator, param_grid, cv, warm_start=False,
+                 n_jobs=1, temp_folder=None, memo=None, ids=None,
+                 memo_key=()):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.warm_start = warm_start
+        self.n_jobs = n_jobs
+        self.temp_folder = temp_folder
+        self.memo = memo
+        self.ids = ids
+        self.memo_key = memo_key
+
+    def fit(self, documents, y):
+        candidates = list(ParameterGrid(self.param_grid))
+        folds = list(self.cv.split(documents, y) if hasattr(self.cv, 'split')
+                     else self.cv)
+        f1 = np.full((len(candidates), len(folds)), np.nan)
+        auc = np.full((len(candidates), len(folds)), np.nan)
+
+        jobs = [(j, group) for j in range(len(folds))
+                for group in group_candidates(candidates)]
+        counts = {}
+        try:
+            self.score_jobs(jobs, documents, np.asarray(y), candidates, folds,
+                            f1, auc, counts)
+        finally:
+            release_counts(counts)
+
+        self.cv_results_, self.best_index_ = search_cv_results(
+            candidates, dict(f1=f1, auc=auc))
+        self.best_params_ = candidates[self.best_index_]
+
+        return self
+
+    def score_jobs(self, jobs, documents, y, candidates, folds, f1, auc,
+                   counts):
+        """Score the (fold index, group of candidates) 'jobs' and write the
+        scores in the arrays f1 and auc (n_candidates, n_splits). The count
+        matrix of the documents is computed by the first call with missing
+        jobs and kept in the dictionary 'counts' for the next calls (with
+        n_jobs > 1, only the path of its memory-mapped file and the pool of
+        workers are kept, see load_counts)."""
+
+        def record(scores, j):
+            for k, (f1_k, auc_k) in scores.items():
+                f1[k, j] = f1_k
+                auc[k, j] = auc_k
+
+        # Jobs already in the memo.
+        job_keys = {}
+        if self.memo is not None:
+            parameters = model_parameters(self.estimator)
+            for j, group in jobs:
+                i_train, i_test = folds[j]
+                job_keys[j, tuple(group)] = (
+                    self.memo_key, self.ids[i_train], self.ids[i_test],
+                    group, [candidates[k] for k in group], parameters,
+                    self.warm_start)
+            todo = []
+            for j, group in jobs:
+                scores = self.memo.fetch(job_keys[j, tuple(group)])
+                if scores is None:
+                    todo.append((j, group))
+                else:
+                    record(scores, j)
+            jobs = todo
+
+        def record_job(scores, j, group):
+            record(scores, j)
+            if self.memo is not None:
+                self.memo.save(job_keys[j, tuple(group)], scores)
+
+        if not jobs:
+            return
+        if not counts:
+            self.load_counts(documents, y, counts)
+
+        if self.n_jobs == 1:
+            X, token_ids = counts['X'], counts['token_ids']
+            for j, group in jobs:
+                i_train, i_test = folds[j]
+                record_job(score_counts_fold(self.estimator, candidates,
+                                             group, X, token_ids, y, i_train,
+                                             i_test,
+                                             warm_start=self.warm_start),
+                           j, group)
+        else:
+            futures = {counts['executor'].submit(
+                score_counts_fold_job, counts['path'], self.estimator,
+                candidates, group, *folds[j], self.warm_start): (j, group)
+                for j, group in jobs}
+            for future in as_completed(futures):
+                record_job(future.result(), *futures[future])
+
+    def load_counts(self, documents, y, counts):
+        """Compute the count matrix of the documents and store it in the
+        dictionary 'counts'. With n_jobs > 1, the matrix is saved once in a
+        joblib file of a new folder of 'temp_folder' and only the path of
+        the file, the folder and a pool of workers are stored, so this
+        process does not keep its own copy while the workers read the
+        memory-mapped one. The folder and the pool are released by
+        release_counts."""
+        vectorizer = self.estimator['tfidfvectorizer']
+        token_ids = np.unique(vectorizer.column_ids(
+            np.concatenate(list(documents))))
+        X = vectorizer.count(documents, token_ids)
+        if self.n_jobs == 1:
+            counts.update(X=X, token_ids=token_ids)
+            return
+        counts['folder'] = mkdtemp(dir=self.temp_folder)
+        counts['path'] = os.path.join(counts['folder'], 'counts.pkl')
+        dump((X, token_ids, y), counts['path'])
+        del X  # The workers read the memory-mapped copy.
+        counts['executor'] = ProcessPoolExecutor(max_workers=self.n_jobs)
+
+
+def release_counts(counts):
+    """Shut down the pool of workers and remove the folder of the count
+    matrix stored by CountsSearchCV.load_counts in 'counts', if any."""
+    if 'executor' in counts:
+        counts.pop('executor').shutdown(cancel_futures=True)
+    if 'folder' in counts:
+        rmtree(counts.pop('folder'), ignore_errors=True)
+
+
+class HalvingSearchCV(CountsSearchCV):
+    """HalvingSearchCV
+    Successive halving version of CountsSearchCV. The candidates are first
+    scored on the 'min_folds' first folds, then only the best
+    1/'factor' of them (mean F1 on the folds scored so far) are scored on
+    'factor' times more folds, and so on until the last fold. The best
+    candidate is the best of the candidates scored on all the folds, so
+    its cross validation scores are the ones of CountsSearchCV. The
+    eliminated candidates keep NaN scores on the folds they were not
+    scored on (NaN means in cv_results_, ranked last).
+    """
+
+    def __init__(self, estimator, param_grid, cv, factor=3, min_folds=2,
+                 warm_start=False, n_jobs=1, temp_folder=None, memo=None,
+                 ids=None, memo_key=()):
+        super().__init__(estimator, param_grid, cv, warm_start=warm_start,
+                         n_jobs=n_jobs, temp_folder=temp_folder, memo=memo,
+                         ids=ids, memo_key=memo_key)
+        self.factor = factor
+        self.min_folds = min_folds
+
+    def fit(self, documents, y):
+        candidates = list(ParameterGrid(self.param_grid))
+        folds = list(self.cv.split(documents, y) if hasattr(self.cv, 'split')
+                     else self.cv)
+        f1 = np.full((len(candidates), len(folds)), np.nan)
+        auc = np.full((len(candidates), len(folds)), np.nan)
+        y = np.asarray(y)
+        counts = {}
+
+        remaining = list(range(len(candidates)))
+        first_fold, last_fold = 0, min(self.min_folds, len(folds))
+        try:
+            while True:
+                groups = [[k for k in group if k in remaining]
+                          for group in group_candidates(candidates)]
+                jobs = [(j, group) for j in range(first_fold, last_fold)
+                        for group in groups if group]
+                self.score_jobs(jobs, documents, y, candidates, folds, f1,
+                                auc, counts)
+                if last_fold == len(folds):
+                    break
+                # Stable sort: ties are broken by the order of the grid, as
+                # the ranks of GridSearchCV.
+                means = np.mean(f1[remaining, :last_fold], axis=1)
+                order = np.argsort(-means, kind='stable')
+                n_kept = max(1, int(np.ceil(len(remaining)/self.factor)))
+                remaining = sorted(remaining[i] for i in order[:n_kept])
+                first_fold, last_fold = (
+                    last_fold, min(last_fold*self.factor, len(folds)))
+        finally:
+            release_counts(counts)
+
+        self.cv_results_, self.best_index_ = search_cv_results(
+            candidates, dict(f1=f1, auc=auc))
+        self.best_params_ = candidates[self.best_index_]
+        self.n_scored_ = np.sum(~np.isnan(f1))
+
+        return self
+
+
+class PathSearchCV:
+    """PathSearchCV
+    Grid search of an lr_cv pipeline (samplers and transformers followed by
+    LogisticRegression) with the same cv_results_, best_index_ and
+    best_params_ keys as GridSearchCV(refit='f1'). On each fold, the steps
+    before LogisticRegression are fitted once for each value of their
+    parameters and the C values are fitted in increasing order, each fit
+    warm-started from the coefficients of the previous one (the scores agree
+    with GridSearchCV up to the solver tolerance).
+    """
+
+    def __init__(self, estimator, param_grid, cv):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+
+    def fit(self, X, y):
+        candidates = list(ParameterGrid(self.param_grid))
+        folds = list(self.cv.split(X, y) if hasattr(self.cv, 'split')
+                     else self.cv)
+        f1 = np.full((len(candidates), len(folds)), np.nan)
+        auc = np.full((len(candidates), len(folds)), np.nan)
+
+        for j, (i_train, i_test) in enumerate(folds):
+            for group in group_candidates(candidates):
+                pipeline = clone(self.estimator).set_params(
+                    **candidates[group[0]])
+                X_train = X.iloc[i_train]
+                y_train = y[i_train]
+                X_test = X.iloc[i_test]
+                y_test = y[i_test]
+
+                # Samplers are only applied to the training fold.
+                for name, step in pipeline.steps[:-1]:
+                    if hasattr(step, 'fit_resample'):
+                        X_train, y_train = step.fit_resample(X_train, y_train)
+                    else:
+                        X_train = step.fit_transform(X_train, y_train)
+                        X_test = step.transform(X_test)
+
+                scores = score_candidates(self.estimator, candidates, group,
+                                          X_train, y_train, X_test, y_test,
+                                          warm_start=True)
+                for k, (f1_k, auc_k) in scores.items():
+                    f1[k, j] = f1_k
+                    auc[k, j] = auc_k
+
+        self.cv_results_, self.best_index_ = search_cv_results(
+            candidates, dict(f1=f1, auc=auc))
+        self.best_params_ = candidates[self.best_index_]
+
+        return self
+
+
+def solve_rates(table, C=1.0, random_state=None):
+    """This function fits the LogisticRegression of the one-hot encoded
+    categories from the contingency table 'table' (n_categories, 2) of the
+    (weighted) numbers of rows of each category with the label 0 and 1:
+    each category x label cell is a single row weighted by its count, so
+    the loss, its gradient and the iterations of the solver are the ones of
+    the fit on the rows (up to rounding). It returns the coefficients of
+    the categories and the intercept.
+    """
+    n_categories = len(table)
+    X = sp.vstack([sp.identity(n_categories, format='csr')]*2).tocsr()
+    y = np.repeat([0, 1], n_categories)
+    weights = np.concatenate([table[:, 0], table[:, 1]])
+    kept = weights > 0
+    clf = LogisticRegression(C=C, random_state=random_state)
+    clf.fit(X[kept], y[kept], sample_weight=weights[kept])
+    return clf.coef_[0], clf.intercept_[0]
+
+
+def category_table(codes, y, n_categories, weights=None):
+    """Contingency table (n_categories, 2) of the (weighted) numbers of rows
+    of each category code and label."""
+    return np.bincount(2*codes + np.asarray(y, dtype=np.int64),
+                       weights=weights,
+                       minlength=2*n_categories).reshape(n_categories, 2)
+
+
+def score_table(table, predictions):
+    """F1 macro and AUC (of the predicted labels) of the predictions of each
+    category (array of 0/1) on the contingency table 'table', the same as
+    score_predictions on the rows."""
+    tp, fn = table[predictions == 1, 1].sum(), table[predictions == 0, 1].sum()
+    fp, tn = table[predictions == 1, 0].sum(), table[predictions == 0, 0].sum()
+    f1_1 = 2*tp/(2*tp + fp + fn) if tp + fp + fn else 0.0
+    f1_0 = 2*tn/(2*tn + fp + fn) if tn + fp + fn else 0.0
+    if tp + fn == 0 or tn + fp == 0:
+        return (f1_1 + f1_0)/2, np.nan
+    return (f1_1 + f1_0)/2, (tp/(tp + fn) + tn/(tn + fp))/2
+
+
+class StageRatesClassifier(BaseEstimator):
+    """StageRatesClassifier
+    Same model as the stage/grade pipeline of lr_cv (OneHotEncoder with
+    handle_unknown='ignore', RandomOverSampler and LogisticRegression) on
+    a single categorical column, fitted from the contingency table of the
+    categories and labels, weighted by the oversampling draws (see
+    solve_rates), so the fit does not depend on the number of rows. The
+    unknown categories only receive the intercept.
+    """
+
+    def __init__(self, C=1.0, random_state=None):
+        self.C = C
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        values = np.asarray(X)[:, 0]
+        y = np.asarray(y)
+        self.categories_ = pd.Index(pd.unique(values))
+        self.classes_ = np.array([0, 1])
+        table = category_table(self.categories_.get_indexer(values), y,
+                               len(self.categories_),
+                               oversampling_weights(y, self.random_state))
+        self.coef_, self.intercept_ = solve_rates(
+            table, C=self.C, random_state=self.random_state)
+        return self
+
+    def decision_function(self, X):
+        codes = self.categories_.get_indexer(np.asarray(X)[:, 0])
+        # The code -1 of the unknown categories selects the last 0.
+        return np.append(self.coef_, 0.0)[codes] + self.intercept_
+
+    def predict_proba(self, X):
+        p = 1/(1 + np.exp(-self.decision_function(X)))
+        return np.column_stack([1 - p, p])
+
+    def predict(self, X):
+        return (self.decision_function(X) > 0).astype(np.int64)
+
+
+class RatesSearchCV:
+    """RatesSearchCV
+    Grid search of the 'logisticregression__C' values of the stage/grade
+    model of lr_cv with the same cv_results_, best_index_ and best_params_
+    keys as GridSearchCV(refit='f1'). The categories are coded once, each
+    fold is reduced to the contingency tables of its training rows
+    (weighted by the oversampling draws of 'random_state') and of its
+    validation rows, and each C is solved and scored from these tables
+    (see StageRatesClassifier). The categories missing from the training
+    rows of a fold get a zero coefficient, as the unknown categories of
+    OneHotEncoder(handle_unknown='ignore').
+    """
+
+    def __init__(self, param_grid, cv, random_state=None):
+        self.param_grid = param_grid
+        self.cv = cv
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        candidates = list(ParameterGrid(self.param_grid))
+        folds = list(self.cv.split(X, y) if hasattr(self.cv, 'split')
+                     else self.cv)
+        f1 = np.full((len(candidates), len(folds)), np.nan)
+        auc = np.full((len(candidates), len(folds)), np.nan)
+
+        y = np.asarray(y)
+        codes, categories = pd.factorize(np.asarray(X)[:, 0],
+                                         use_na_sentinel=False)
+        for j, (i_train, i_test) in enumerate(folds):
+            table_train = category_table(
+                codes[i_train], y[i_train], len(categories),
+                oversampling_weights(y[i_train], self.random_state))
+            table_test = category_table(codes[i_test], y[i_test],
+                                        len(categories))
+            for k, candidate in enumerate(candidates):
+                coef, intercept = solve_rates(
+                    table_train, C=candidate['logisticregression__C'],
+                    random_state=self.random_state)
+                f1[k, j], auc[k, j] = score_table(
+                    table_test, (coef + intercept > 0).astype(np.int64))
+
+        self.cv_results_, self.best_index_ = search_cv_results(
+            candidates, dict(f1=f1, auc=auc))
+        self.best_params_ = candidates[self.best_index_]
+
+        return self
+
+
 def lr_cv(disease, year_survival=5, period_of_analysis_days=None,
           kfold=5, random_state=17, authortype_list=None,
-          added_features_list=None):
+          added_features_list=None, text_search='grid', stage_search='grid',
+          cache_dir=None, cache_size=8e9, oversampling='rows',
+          arena_dir=None, search_jobs=1, vectorizer='tokens',
+          model_dir=None, memo_dir=None, trace_path=None,
+          profile_stage=None):
     """This is the main function to obtain the NLP experiment results.
     
     The function lr_cv (logistic regression - cross validation) performs
@@ -362,7 +1896,9 @@ def lr_cv(disease, year_survival=5, period_of_analysis_days=None,
     Parameters
     ----------
      disease:
-         One of the values from ('breast','prostate','lung','glioma').
+         One of the values from ('breast','prostate','lung','glioma'), or a
+         NotesCorpus loaded with the same 'year_survival' and
+         'authortype_list' (to share the notes between several runs).
      year_survival:
          Threshold to define survival.
      period_of_analysis_days:
@@ -375,6 +1911,63 @@ def lr_cv(disease, year_survival=5, period_of_analysis_days=None,
          List of authors considered as valid.
      added_features_list:
          Features from the input dataset conserved in the output.
+     text_search:
+         Hyperparameter search of the text model: 'grid' (GridSearchCV),
+         'counts' (CountsSearchCV, same results with one count matrix per
+         fold), 'path' (CountsSearchCV with the C values warm-started in
+         increasing order) or 'halving' (HalvingSearchCV, the candidates
+         are scored on 2 folds, then the best third of them on the other
+         folds).
+     stage_search:
+         Hyperparameter search of the stage/grade model: 'grid'
+         (GridSearchCV), 'path' (PathSearchCV, C values warm-started in
+         increasing order) or 'rates' (RatesSearchCV and
+         StageRatesClassifier, the model is fitted from the numbers of
+         patients of each category and label).
+     cache_dir:
+         Folder of the persistent TransformerCache of the fitted tf-idf
+         transforms (None uses a temporary folder for each time point).
+     cache_size:
+         Maximum size of the cache in bytes.
+     oversampling:
+         Oversampling of the minority class: 'rows' (RandomOverSampler
+         copies the rows) or 'weights' (same draws used as sample weights of
+         LogisticRegression, without copying the rows).
+     arena_dir:
+         Folder of the NotesArena of the corpus (None keeps the concatenated
+         texts in memory). With an arena, the 'train' and 'test' sets have
+         the columns 'note_start' and 'note_stop' instead of 'text'. The
+         texts of a corpus loaded from 'disease' are then released (a
+         NotesCorpus given in 'disease' is not modified, see
+         NotesCorpus.release_texts).
+     search_jobs:
+         Number of worker processes of the text hyperparameter search
+         (text_search 'counts', 'path' or 'halving' only). The workers
+         share a memory-mapped copy of the count matrix.
+     vectorizer:
+         Columns of the tf-idf of the text: 'tokens' (the terms, as
+         TfidfVectorizer) or 'hashing' (2**20 hashed buckets of the terms,
+         as HashingVectorizer, with the idf computed from the hashed
+         counts). With 'hashing', the feature names are the terms of each
+         bucket joined by '|'.
+     model_dir:
+         Folder where the final models of each time point are saved as a
+         PeriodModel (None to discard them), in the file
+         {first time point}_{random_state}_{time point}.pkl (see
+         load_period_models and score_notes).
+     memo_dir:
+         Folder of the FitMemo of the model fits, shared by the seeds and
+         the runs on the same corpus (None to disable it).
+     trace_path:
+         JSON-lines file of the StageTrace of the run: wall time, CPU time
+         and peak memory of each stage, tagged with the disease, the seed
+         and the time point (None to disable it, see load_trace). The
+         stages are 'load_notes', 'group_notes', 'combined_notes',
+         'train_test_sets', 'tokenize', 'text_search', 'text_fit',
+         'feature_selection', 'stage_search', 'stage_fit' and
+         'save_model'.
+     profile_stage:
+         Name of the stage run under cProfile (None to disable it).
 
     Return
     ------
@@ -409,6 +2002,9 @@ def lr_cv(disease, year_survival=5, period_of_analysis_days=None,
          List of importants features for each time point.
      predictions:
          List of predictions for the test set for each time point.
+     probabilities:
+         List of predicted probabilities of the label 1 for the test set for
+         each time point.
      val_f1_s:
          List of tuples (mean, std) of test sets F1 metric in the grid search
          best index for each time point. (stage/grade approach)
@@ -433,6 +2029,9 @@ def lr_cv(disease, year_survival=5, period_of_analysis_days=None,
      predictions_s:
          Lis of predictions for the test set for each time point.
          (stage/grade approach)
+     probabilities_s:
+         List of predicted probabilities of the label 1 for the test set for
+         each time point. (stage/grade approach)
      train: 
          List of the complete training sets with added columns with the
          predictions for the two approaches for each time point.
@@ -443,285 +2042,401 @@ def lr_cv(disease, year_survival=5, period_of_analysis_days=None,
          Seed used by the random number generator.
     """
 
-    # Initializations:
-    val_f1 = []
-    val_area_under_curve = []
-    tfidf_param_text = []
-    C_param_text = []
-    f1_train = []
-    area_under_curve_train = []
-    n = []
-    f1 = []
-    area_under_curve = []
-    n_test = []
-    feature_names = []
-    predictions = []
-    tain_list = []
-    val_f1_s = []
-    val_area_under_curve_s = []
-    C_param_s = []
-    f1_train_s = []
-    area_under_curve_train_s = []
-    f1_s = []
-    area_under_curve_s = []
-    predictions_s = []
-    test_list = []
-    id_list_flag = True
-    idlist = []
-    test_ids = []
-    train = None
-    test = None
-    train_frac = 0.8
     unic_label = False  # Nested stratification is done when value is False.
-    ngram = 1
-    max_features = 200  # For feature importance.
-    examples_col_names = ['id', 'overallsurvival',
-                          'vitalstatusbinary',
-                          'stage_grade',
-                          'id_count'
-                          ] + added_features_list + ['text_length', 'text']
-    labels_col_names = ['stage_grade', 'label']
-    scoring = {'f1': make_scorer(f1_score, average='macro'),
-               'auc': make_scorer(roc_auc_score)}
-
-    parameter_grid = {'logisticregression__C': [0.1, 1, 10, 100, 1000],
-                      'tfidfvectorizer__max_features': [500, 1000, None]}
-    parameter_grid_stage = {'logisticregression__C': [0.1, 1, 10, 100, 1000]}
     if period_of_analysis_days is None:
         period_of_analysis_days = [30, 365]
 
+    trace = StageTrace(trace_path, profile_stage,
+                       disease=getattr(disease, 'disease', disease),
+                       seed=random_state)
+
+    # Load the notes once for all the time points.
+    trace.begin('load_notes')
+    corpus = load_corpus(disease, year_survival=year_survival,
+                         authortype_list=authortype_list)
+
+    arena = None
+    if arena_dir is not None:
+        arena = load_arena(corpus, arena_dir, added_features_list)
+        if corpus is not disease:
+            # The corpus was loaded here, only its arena is used.
+            corpus.release_texts()
+    trace.end()
+    if model_dir is not None:
+        os.makedirs(model_dir, exist_ok=True)
+    memo = None
+    if memo_dir is not None:
+        memo = FitMemo(memo_dir, context=corpus.version(), max_bytes=cache_size)
+
+    # The notes of all the time points are concatenated in a single sweep.
+    notes_by_period = iter_combined_notes(
+        corpus, period_of_analysis_days, year_survival=year_survival,
+        authortype_list=authortype_list,
+        added_features_list=added_features_list, arena=arena, trace=trace)
+
     # Main loop: Solving the problem at each time point.
-    for period in period_of_analysis_days:
+    results_period_list = []
+    idlist = None
+    test_ids = None
+    for period, df in notes_by_period:
         print(f"Period in days: {period}")
+        period_trace = trace.tagged(period=period)
 
         # 1. Define train and test set.
-
-        if id_list_flag:
-            id_list_flag = False
-            df = combined_notes(
-                disease, year_survival=year_survival, period=period,
-                authortype_list=authortype_list,
-                added_features_list=added_features_list)
+        period_trace.begin('train_test_sets')
+        train, test = train_test_sets(df, random_state=random_state,
+                                      added_features_list=added_features_list,
+                                      test_ids=test_ids, idlist=idlist,
+                                      unic_label=unic_label)
+        if test_ids is None:
             idlist = df['id'].copy().tolist()
-            if unic_label:
-                examples = df[examples_col_names].copy()
-                labels = df['label'].copy()
-                X_tr, X_te, y_tr, y_te = train_test_split(examples, labels,
-                                                          train_size=train_frac,
-                                                          stratify=labels,
-                                                          random_state=random_state)
-                train = pd.concat([y_tr, X_tr], axis=1).reset_index(drop=True)
-                test = pd.concat([y_te, X_te], axis=1).reset_index(drop=True)
-            else:
-                train, test = nested_train_test_split(df, examples_col_names,
-                                                      labels_col_names,
-                                                      train_frac=train_frac,
-                                                      random_state=random_state)
             test_ids = test['id'].copy().tolist()
             print('text is in df:', df.columns)
-        else:
-            df = combined_notes(disease, period=period,
-                                year_survival=year_survival, idlist=idlist,
-                                authortype_list=authortype_list,
-                                added_features_list=added_features_list)
-            train = df[~df['id'].isin(
-                test_ids)].copy().reset_index(drop=True)
-            test = df[df['id'].isin(test_ids)].copy().reset_index(drop=True)
-
-        train['is_test'] = False
-        test['is_test'] = True
-
-        # 2. NLP.
-
-        # Create a temporary folder to store the transformers of the pipeline.
-        cachedir = mkdtemp()
-        memory = Memory(location=cachedir, verbose=10)
-        pipeline = Pipeline([('tfidfvectorizer',
-                              TfidfVectorizer(ngram_range=(1, ngram),
-                                              tokenizer=tokenize,
-                                              min_df=3,
-                                              max_df=0.9,
-                                              strip_accents='unicode',
-                                              use_idf=1,
-                                              smooth_idf=1,
-                                              sublinear_tf=1)),
-                             ('randomOversampler',
-                              RandomOverSampler(random_state=random_state)),
-                             ('logisticregression',
-                              LogisticRegression(random_state=random_state))],
-                            memory=memory)
 
+        # 2. NLP and 3. Stage.
+        results_period_list.append(lr_cv_period(train, test, period,
+                                                kfold=kfold,
+                                                random_state=random_state,
+                                                unic_label=unic_label,
+                                                text_search=text_search,
+                                                stage_search=stage_search,
+                                                cache_dir=cache_dir,
+                                                cache_size=cache_size,
+                                                oversampling=oversampling,
+                                                arena=arena,
+                                                search_jobs=search_jobs,
+                                                vectorizer=vectorizer,
+                                                model_path=model_file(
+                                                    model_dir,
+                                                    period_of_analysis_days[0],
+                                                    random_state, period),
+                                                memo=memo,
+                                                trace=period_trace))
+
+    return collect_lr_cv_results(results_period_list, random_state)
+
+
+def train_test_sets(df, random_state=17, added_features_list=None,
+                    test_ids=None, idlist=None, unic_label=False):
+    """This function defines the training and test sets of one time point.
+    At the first time point ('test_ids' is None) the ids are split with a
+    nested stratification by 'stage_grade' and 'label'. At the next time
+    points, only the ids in 'idlist' are kept and the ids in 'test_ids' are
+    used as test set."""
+
+    train_frac = 0.8
+    if added_features_list is None:
+        added_features_list = []
+    examples_col_names = ['id', 'overallsurvival',
+                          'vitalstatusbinary',
+                          'stage_grade',
+                          'id_count'
+                          ] + added_features_list + ['text_length']
+    # Concatenated text, or its position in a NotesArena.
+    if 'text' in df.columns:
+        examples_col_names += ['text']
+    else:
+        examples_col_names += ['note_start', 'note_stop']
+    labels_col_names = ['stage_grade', 'label']
+
+    if test_ids is None:
         if unic_label:
-            x_train = train['text'].copy()
-            y_train = train['label'].values.copy()
-            cross_validation = StratifiedKFold(n_splits=kfold,
-                                               shuffle=True,
-                                               random_state=random_state)
+            examples = df[examples_col_names].copy()
+            labels = df['label'].copy()
+            X_tr, X_te, y_tr, y_te = train_test_split(examples, labels,
+                                                      train_size=train_frac,
+                                                      stratify=labels,
+                                                      random_state=random_state)
+            train = pd.concat([y_tr, X_tr], axis=1).reset_index(drop=True)
+            test = pd.concat([y_te, X_te], axis=1).reset_index(drop=True)
         else:
-            # Nested stratification.
-            x_train_2col = train[['stage_grade', 'text']].copy()
-            x_train = train['text'].copy()
-            y_train = train['label'].values.copy()
-            cross_validation = CatStratifiedKFold(n_splits=kfold,
-                                                  shuffle=True,
-                                                  random_state=random_state
-                                                  ).split(x_train_2col,
-                                                          y_train)
-
-        x_test = test['text'].copy()
-        y_test = test['label'].values.copy()
+            train, test = nested_train_test_split(df, examples_col_names,
+                                                  labels_col_names,
+                                                  train_frac=train_frac,
+                                                  random_state=random_state)
+    else:
+        # This select notes from ids of the first time point only.
+        if idlist:
+            df = df[df['id'].isin(idlist)].copy()
+            df.reset_index(inplace=True, drop=True)
+            print(df.shape)
+        train = df[~df['id'].isin(
+            test_ids)].copy().reset_index(drop=True)
+        test = df[df['id'].isin(test_ids)].copy().reset_index(drop=True)
+
+    train['is_test'] = False
+    test['is_test'] = True
+
+    return train, test
+
+
+def lr_cv_period(train, test, period, kfold=5, random_state=17,
+                 unic_label=False, text_search='grid', stage_search='grid',
+                 cache_dir=None, cache_size=8e9, oversampling='rows',
+                 arena=None, search_jobs=1, vectorizer='tokens',
+                 model_path=None, memo=None, trace=None):
+    """This function solves the problem at one time point: tf-idf + logistic
+    regression on the text (2. NLP) and logistic regression on the
+    stage/grade (3. Stage). It returns a dictionary with the keys of the
+    lr_cv output, with the value of this time point only (the 'train' and
+    'test' sets receive the prediction columns). With 'model_path', the
+    final models are saved in this file as a PeriodModel. With the FitMemo
+    'memo', the searches and the final models are memoized under the ids
+    of the training patients (and of the folds), the time point and the
+    vocabulary of the token ids (text only, the stage/grade does not depend
+    on them) and the model parameters. The stages are timed in the StageTrace 'trace'."""
+
+    max_features = 200  # For feature importance.
+    scoring = {'f1': make_scorer(f1_score, average='macro'),
+               'auc': make_scorer(roc_auc_score)}
+
+    parameter_grid = {'logisticregression__C': [0.1, 1, 10, 100, 1000],
+                      'tfidfvectorizer__max_features': [500, 1000, None]}
+    parameter_grid_stage = {'logisticregression__C': [0.1, 1, 10, 100, 1000]}
+
+    if trace is None:
+        trace = StageTrace()
+
+    # 2. NLP.
 
+    # Tokenize the notes of this time point once for all the tf-idf fits
+    # (the token ids are read from the arena when it is given).
+    trace.begin('tokenize')
+    if arena is None:
+        documents, terms = tokenize_documents(pd.concat([train['text'],
+                                                         test['text']]).tolist())
+    else:
+        documents = arena.documents(
+            np.concatenate([train['note_start'], test['note_start']]),
+            np.concatenate([train['note_stop'], test['note_stop']]))
+        terms = arena.terms
+    documents_train = documents.iloc[:len(train)].reset_index(drop=True)
+    documents_test = documents.iloc[len(train):].reset_index(drop=True)
+
+    # The memoized text fits depend on the numbering of the token ids, which
+    # is identified by the vocabulary (it differs with and without arena).
+    vocabulary = None if memo is None else joblib_hash(terms)
+
+    # Tf-idf of the terms ('tokens') or of their hashed buckets ('hashing').
+    if vectorizer == 'hashing':
+        tfidf_options = dict(buckets=hash_terms(terms))
+        tfidf_vectorizer = HashingTfidfVectorizer
+    else:
+        tfidf_options = {}
+        tfidf_vectorizer = TokenTfidfVectorizer
+
+    # Cache of the transformers of the pipelines (temporary folder when
+    # 'cache_dir' is None).
+    memory = TransformerCache(cache_dir, max_bytes=cache_size)
+    pipeline = Pipeline([('tfidfvectorizer',
+                          tfidf_vectorizer(min_df=3,
+                                           max_df=0.9,
+                                           use_idf=1,
+                                           smooth_idf=1,
+                                           sublinear_tf=1,
+                                           **tfidf_options))]
+                        + oversampled_lr_steps(random_state, oversampling),
+                        memory=memory)
+
+    if unic_label:
+        x_train = documents_train
+        y_train = train['label'].values.copy()
+        cross_validation = StratifiedKFold(n_splits=kfold,
+                                           shuffle=True,
+                                           random_state=random_state
+                                           ).split(x_train, y_train)
+    else:
+        # Nested stratification.
+        x_train_2col = train[['stage_grade']].copy()
+        x_train = documents_train
+        y_train = train['label'].values.copy()
+        cross_validation = CatStratifiedKFold(n_splits=kfold,
+                                              shuffle=True,
+                                              random_state=random_state
+                                              ).split(x_train_2col,
+                                                      y_train)
+
+    x_test = documents_test
+    y_test = test['label'].values.copy()
+    ids_train = train['id'].values
+    cross_validation = list(cross_validation)
+
+    if text_search in ('counts', 'path'):
+        grid_search = CountsSearchCV(pipeline, param_grid=parameter_grid,
+                                     cv=cross_validation,
+                                     warm_start=text_search == 'path',
+                                     n_jobs=search_jobs, memo=memo,
+                                     ids=ids_train,
+                                     memo_key=('text_fold', period,
+                                               vocabulary))
+    elif text_search == 'halving':
+        grid_search = HalvingSearchCV(pipeline, param_grid=parameter_grid,
+                                      cv=cross_validation,
+                                      n_jobs=search_jobs, memo=memo,
+                                      ids=ids_train,
+                                      memo_key=('text_fold', period,
+                                                vocabulary))
+    elif search_jobs != 1:
+        raise ValueError("search_jobs requires text_search='counts', 'path' "
+                         "or 'halving' (GridSearchCV would copy the "
+                         "documents to every worker).")
+    else:
         grid_search = GridSearchCV(pipeline, param_grid=parameter_grid,
                                    scoring=scoring, refit='f1',
                                    cv=cross_validation)
 
-        # Fit.
-        grid_search.fit(x_train, y_train)
-        
-        # Clear the cache directory when you don't need it anymore.
-        rmtree(cachedir)
-        
-        
-        # Record cross validation metrics.
-        val_f1.append((grid_search.cv_results_['mean_test_f1'][grid_search.best_index_],
-                       grid_search.cv_results_['std_test_f1'][grid_search.best_index_]))
-
-        val_area_under_curve.append((grid_search.cv_results_['mean_test_auc'][grid_search.best_index_],
-                                     grid_search.cv_results_['std_test_auc'][grid_search.best_index_]))
-
-        # Record cross validation hyperparameters.
-        tfidf_param_text.append(grid_search.best_params_['tfidfvectorizer__max_features'])
-        C_param_text.append(grid_search.best_params_['logisticregression__C'])
-
-        # Final model.
-        pipeline_final = Pipeline([('tfidfvectorizer',
-                                    TfidfVectorizer(ngram_range=(1, ngram),
-                                                    tokenizer=tokenize,
-                                                    min_df=3,
-                                                    max_df=0.9,
-                                                    strip_accents='unicode',
-                                                    use_idf=1,
-                                                    smooth_idf=1,
-                                                    sublinear_tf=1,
-                                                    max_features=grid_search.best_params_['tfidfvectorizer__max_features'])),
-                                   ('randomOversampler',
-                                    RandomOverSampler(random_state=random_state)),
-                                   ('logisticregression',
-                                    LogisticRegression(random_state=random_state,
-                                                       C=grid_search.best_params_['logisticregression__C']))])
-
-        final_model = pipeline_final.fit(x_train, y_train)
-        preds_train = final_model.predict(x_train)
-
-        # Add predictions in train DF.
-        train[str(period)+'_tf_pred'] = preds_train
-        train_f1 = f1_score(y_train, preds_train, average='macro')
-        f1_train.append((train_f1, 0))  # Record train f1
-        train_auc = roc_auc_score(y_train, preds_train)
-        area_under_curve_train.append((train_auc, 0))  # Record train auc.
-        n.append(len(train))  # Add number of examples in train.
-        preds_test = final_model.predict(x_test)
-
-        # Add predictions in test DF.
-        test[str(period)+'_tf_pred'] = preds_test
-        predictions.append(preds_test)  # Add predictions in list.
-        test_f1 = f1_score(y_test, preds_test, average='macro')
-        f1.append((test_f1, 0))  # Record test f1.
-        test_auc = roc_auc_score(y_test, preds_test)
-        area_under_curve.append((test_auc, 0))  # Record test auc.
-        n_test.append(len(test))  # Add number of examples in test.
-
-        # Selecting features.
-        pip_tfidf_ros = Pipeline([('tfidfvectorizer',
-                                   TfidfVectorizer(ngram_range=(1, ngram),
-                                                   tokenizer=tokenize,
-                                                   min_df=3,
-                                                   max_df=0.9,
-                                                   strip_accents='unicode',
-                                                   use_idf=1,
-                                                   smooth_idf=1,
-                                                   sublinear_tf=1,
-                                                   max_features=grid_search.best_params_['tfidfvectorizer__max_features'])),
-                                  ('randomOversampler',
-                                   RandomOverSampler(random_state=random_state))])
-
-        X_res, y_res = pip_tfidf_ros.fit_resample(x_train, y_train)
-        clf = LogisticRegression(random_state=random_state,
-                                 C=grid_search.best_params_['logisticregression__C'])
-        sfm = SelectFromModel(clf, threshold=-np.inf,
-                              max_features=max_features)
-        sfm.fit(X_res, y_res)
-        embeded_lr_support = sfm.get_support()
-        X_res_pandas = pd.DataFrame(X_res.todense())
-        embeded_lr_feature = X_res_pandas.loc[:,
-                                              embeded_lr_support].columns.tolist()
-        feature_names_list = np.array(pip_tfidf_ros['tfidfvectorizer'].get_feature_names())[
-            embeded_lr_feature].tolist()
-        feature_names.append(feature_names_list)  # Add importants features.
-
-        # 3. Stage.
-
-        x_train_s = train[['stage_grade']].copy()
-        y_train_s = train['label'].values.copy()
-        x_test_s = test[['stage_grade']].copy()
-        y_test_s = test['label'].values.copy()
-
-        # Create a temporary folder to store the transformers of the pipeline.
-        cachedir = mkdtemp()
-        memory = Memory(location=cachedir, verbose=10)
-        pipeline = Pipeline([('randomOversampler',
-                              RandomOverSampler(random_state=random_state)),
-                             ('onehotencoder',
-                              OneHotEncoder(handle_unknown='ignore')),
-                             ('logisticregression',
-                              LogisticRegression(random_state=random_state))],
-                            memory=memory)
-
-        cross_validation = StratifiedKFold(n_splits=kfold, shuffle=True,
-                                           random_state=random_state)
+    # Fit.
+    trace.begin('text_search')
+    grid_search = fit_search(grid_search, x_train, y_train, memo=memo,
+                             key=('text_search', period, text_search,
+                                  vocabulary, ids_train,
+                                  [ids_train[i_train]
+                                   for i_train, _ in cross_validation],
+                                  parameter_grid,
+                                  model_parameters(pipeline)))
+    
+    
+    # Record cross validation metrics.
+    val_f1 = (grid_search.cv_results_['mean_test_f1'][grid_search.best_index_],
+              grid_search.cv_results_['std_test_f1'][grid_search.best_index_])
+
+    val_area_under_curve = (grid_search.cv_results_['mean_test_auc'][grid_search.best_index_],
+                            grid_search.cv_results_['std_test_auc'][grid_search.best_index_])
+
+    # Record cross validation hyperparameters.
+    tfidf_param_text = grid_search.best_params_['tfidfvectorizer__max_features']
+    C_param_text = grid_search.best_params_['logisticregression__C']
+
+    # Final model.
+    trace.begin('text_fit')
+    pipeline_final = Pipeline([('tfidfvectorizer',
+                                tfidf_vectorizer(min_df=3,
+                                                 max_df=0.9,
+                                                 use_idf=1,
+                                                 smooth_idf=1,
+                                                 sublinear_tf=1,
+                                                 max_features=grid_search.best_params_['tfidfvectorizer__max_features'],
+                                                 **tfidf_options))]
+                              + oversampled_lr_steps(random_state, oversampling,
+                                                     C=grid_search.best_params_['logisticregression__C']))
+
+    final_model = memoize(memo, ('text_model', period, vocabulary,
+                                 ids_train, model_parameters(pipeline_final)),
+                          pipeline_final.fit, x_train, y_train)
+    preds_train = final_model.predict(x_train)
+
+    # Add predictions in train DF.
+    train[str(period)+'_tf_pred'] = preds_train
+    train_f1 = f1_score(y_train, preds_train, average='macro')
+    f1_train = (train_f1, 0)  # Record train f1
+    train_auc = roc_auc_score(y_train, preds_train)
+    area_under_curve_train = (train_auc, 0)  # Record train auc.
+    n = len(train)  # Add number of examples in train.
+    preds_test = final_model.predict(x_test)
+
+    # Add predictions in test DF.
+    test[str(period)+'_tf_pred'] = preds_test
+    test_f1 = f1_score(y_test, preds_test, average='macro')
+    f1 = (test_f1, 0)  # Record test f1.
+    test_auc = roc_auc_score(y_test, preds_test)
+    area_under_curve = (test_auc, 0)  # Record test auc.
+    n_test = len(test)  # Add number of examples in test.
+    probs_test = final_model.predict_proba(x_test)[:, 1]
+
+    # Selecting features. The LogisticRegression step of the final model
+    # is the classifier fitted on the oversampled tf-idf matrix of the
+    # training set, so its coefficients are used directly.
+    trace.begin('feature_selection')
+    sfm = SelectFromModel(final_model['logisticregression'],
+                          threshold=-np.inf, max_features=max_features,
+                          prefit=True)
+    embeded_lr_feature = np.flatnonzero(sfm.get_support())
+    feature_names_list = final_model['tfidfvectorizer'].feature_names(
+        terms, embeded_lr_feature)
+    text_model = final_model
+
+    # 3. Stage.
+
+    trace.begin('stage_search')
+    x_train_s = train[['stage_grade']].copy()
+    y_train_s = train['label'].values.copy()
+    x_test_s = test[['stage_grade']].copy()
+    y_test_s = test['label'].values.copy()
+
+    # The oversampling follows the one-hot encoding (same categories and
+    # draws as when the labels are oversampled first).
+    pipeline = Pipeline([('onehotencoder',
+                          OneHotEncoder(handle_unknown='ignore'))]
+                        + oversampled_lr_steps(random_state, oversampling),
+                        memory=memory)
+
+    cross_validation = list(StratifiedKFold(n_splits=kfold, shuffle=True,
+                                            random_state=random_state
+                                            ).split(x_train_s, y_train_s))
+    if stage_search == 'path':
+        grid_search = PathSearchCV(pipeline, param_grid=parameter_grid_stage,
+                                   cv=cross_validation)
+    elif stage_search == 'rates':
+        pipeline = StageRatesClassifier(random_state=random_state)
+        grid_search = RatesSearchCV(param_grid=parameter_grid_stage,
+                                    cv=cross_validation,
+                                    random_state=random_state)
+    else:
         grid_search = GridSearchCV(pipeline, param_grid=parameter_grid_stage,
                                    scoring=scoring, refit='f1',
                                    cv=cross_validation)
 
 
-        grid_search.fit(x_train_s, y_train_s)
-        
-        # Clear the cache directory when you don't need it anymore.
-        rmtree(cachedir)
-        
-        val_f1_s.append((grid_search.cv_results_['mean_test_f1'][grid_search.best_index_],
-                         grid_search.cv_results_['std_test_f1'][grid_search.best_index_]))
-        val_area_under_curve_s.append((grid_search.cv_results_['mean_test_auc'][grid_search.best_index_],
-                                       grid_search.cv_results_['std_test_auc'][grid_search.best_index_]))
-
-        # Final model.
-        pipeline_final = Pipeline([('randomOversampler',
-                                    RandomOverSampler(random_state=random_state)),
-                                   ('onehotencoder',
-                                    OneHotEncoder(handle_unknown='ignore')),
-                                   ('logisticregression',
-                                    LogisticRegression(random_state=random_state,
-                                                       C=grid_search.best_params_['logisticregression__C']))])
-
-        C_param_s.append(grid_search.best_params_['logisticregression__C'])
-        final_model = pipeline_final.fit(x_train_s, y_train_s)
-        preds_train_s = final_model.predict(x_train_s)
-
-        # Fill the output dictionary values
-        train[str(period)+'_s_pred'] = preds_train_s
-        train_f1_s = f1_score(y_train_s, preds_train_s, average='macro')
-        f1_train_s.append(train_f1_s)
-        train_auc_s = roc_auc_score(y_train_s, preds_train_s)
-        area_under_curve_train_s.append(train_auc_s)
-        preds_test_s = final_model.predict(x_test_s)
-        test[str(period)+'_s_pred'] = preds_test_s
-        predictions_s.append(preds_test_s)
-        test_f1_s = f1_score(y_test_s, preds_test_s, average='macro')
-        f1_s.append((test_f1_s, 0))
-        test_auc_s = roc_auc_score(y_test_s, preds_test_s)
-        area_under_curve_s.append((test_auc_s, 0))
-        tain_list.append(train)
-        test_list.append(test)
+    grid_search = fit_search(grid_search, x_train_s, y_train_s, memo=memo,
+                             key=('stage_search', stage_search, ids_train,
+                                  [ids_train[i_train]
+                                   for i_train, _ in cross_validation],
+                                  parameter_grid_stage,
+                                  model_parameters(pipeline)))
+    
+    # Clear the cache directory when it is temporary.
+    memory.clear()
+    
+    val_f1_s = (grid_search.cv_results_['mean_test_f1'][grid_search.best_index_],
+                grid_search.cv_results_['std_test_f1'][grid_search.best_index_])
+    val_area_under_curve_s = (grid_search.cv_results_['mean_test_auc'][grid_search.best_index_],
+                              grid_search.cv_results_['std_test_auc'][grid_search.best_index_])
+
+    # Final model.
+    trace.begin('stage_fit')
+    if stage_search == 'rates':
+        pipeline_final = StageRatesClassifier(
+            C=grid_search.best_params_['logisticregression__C'],
+            random_state=random_state)
+    else:
+        pipeline_final = Pipeline([('onehotencoder',
+                                    OneHotEncoder(handle_unknown='ignore'))]
+                                  + oversampled_lr_steps(random_state, oversampling,
+                                                         C=grid_search.best_params_['logisticregression__C']))
+
+    C_param_s = grid_search.best_params_['logisticregression__C']
+    final_model = memoize(memo, ('stage_model', ids_train,
+                                 model_parameters(pipeline_final)),
+                          pipeline_final.fit, x_train_s, y_train_s)
+    preds_train_s = final_model.predict(x_train_s)
+
+    # Fill the output dictionary values
+    train[str(period)+'_s_pred'] = preds_train_s
+    train_f1_s = f1_score(y_train_s, preds_train_s, average='macro')
+    train_auc_s = roc_auc_score(y_train_s, preds_train_s)
+    preds_test_s = final_model.predict(x_test_s)
+    probs_test_s = final_model.predict_proba(x_test_s)[:, 1]
+    test[str(period)+'_s_pred'] = preds_test_s
+    test_f1_s = f1_score(y_test_s, preds_test_s, average='macro')
+    f1_s = (test_f1_s, 0)
+    test_auc_s = roc_auc_score(y_test_s, preds_test_s)
+    area_under_curve_s = (test_auc_s, 0)
+
+    if model_path is not None:
+        trace.begin('save_model')
+        dump_atomic(PeriodModel(period, random_state, text_model, final_model,
+                                terms), model_path)
+    trace.end()
 
     return dict(val_f1=val_f1,
                 val_area_under_curve=val_area_under_curve,
@@ -733,19 +2448,783 @@ def lr_cv(disease, year_survival=5, period_of_analysis_days=None,
                 f1=f1,
                 area_under_curve=area_under_curve,
                 n_test=n_test,
-                feature_names=feature_names,
-                predictions=predictions,
+                feature_names=feature_names_list,
+                predictions=preds_test,
+                probabilities=probs_test,
                 val_f1_s=val_f1_s,
                 val_area_under_curve_s=val_area_under_curve_s,
                 C_param_s=C_param_s,
-                f1_train_s=f1_train_s,
-                area_under_curve_train_s=area_under_curve_train_s,
+                f1_train_s=train_f1_s,
+                area_under_curve_train_s=train_auc_s,
                 f1_s=f1_s,
                 area_under_curve_s=area_under_curve_s,
-                predictions_s=predictions_s,
-                train=tain_list,
-                test=test_list,
-                random_state=random_state)
+                predictions_s=preds_test_s,
+                probabilities_s=probs_test_s,
+                train=train,
+                test=test)
+
+
+def collect_lr_cv_results(results_period_list, random_state):
+    """This function gathers the dictionaries of lr_cv_period (one for each
+    time point) in the output dictionary of lr_cv."""
+
+    results = dict(val_f1=[],
+                   val_area_under_curve=[],
+                   tfidf_param_text=[],
+                   C_param_text=[],
+                   f1_train=[],
+                   area_under_curve_train=[],
+                   n=[],
+                   f1=[],
+                   area_under_curve=[],
+                   n_test=[],
+                   feature_names=[],
+                   predictions=[],
+                   probabilities=[],
+                   val_f1_s=[],
+                   val_area_under_curve_s=[],
+                   C_param_s=[],
+                   f1_train_s=[],
+                   area_under_curve_train_s=[],
+                   f1_s=[],
+                   area_under_curve_s=[],
+                   predictions_s=[],
+                   probabilities_s=[],
+                   train=[],
+                   test=[])
+    for results_period in results_period_list:
+        for key in results:
+            results[key].append(results_period[key])
+    results['random_state'] = random_state
+
+    return results
+
+
+# Notes of each time point in the worker processes of lr_cv_batch.
+_worker_data = {}
+
+
+def init_lr_cv_worker(notes_by_period, added_features_list, period_options):
+    """Initializer of the worker processes of lr_cv_batch. 'notes_by_period'
+    has the notes of each time point or the path of the joblib file where
+    they are saved. 'period_options' are the keyword arguments of
+    lr_cv_period (the 'trace' is tagged with the seed and the time point of
+    each job)."""
+    _worker_data['notes_by_period'] = notes_by_period
+    _worker_data['added_features_list'] = added_features_list
+    _worker_data['period_options'] = period_options
+    _worker_data['loaded'] = {}
+
+
+def worker_notes(periods):
+    """Notes of the time points 'periods' in a worker of lr_cv_batch. The
+    notes saved in a file are loaded and kept only until a job needs other
+    time points, so a worker holds the texts of one job at a time."""
+    notes = {}
+    for period in periods:
+        notes[period] = _worker_data['notes_by_period'][period]
+        if isinstance(notes[period], str):
+            notes[period] = _worker_data['loaded'].get(period)
+            if notes[period] is None:
+                notes[period] = load(
+                    _worker_data['notes_by_period'][period])
+    _worker_data['loaded'] = notes
+    return notes
+
+
+def run_lr_cv_job(random_state, period, first_period, checkpoint=None,
+                  model_path=None):
+    """Solve one seed x time point job of lr_cv_batch. The split of the first
+    time point is computed again in the worker (it only depends on the seed),
+    so the jobs of the same seed are independent. The result is saved in the
+    file 'checkpoint' as soon as it is computed, and the final models in the
+    file 'model_path'."""
+    notes_by_period = worker_notes({first_period, period})
+    added_features_list = _worker_data['added_features_list']
+    period_options = dict(_worker_data['period_options'])
+    trace = period_options.pop('trace').tagged(seed=random_state,
+                                               period=period)
+    trace.begin('train_test_sets')
+    df_first = notes_by_period[first_period]
+    train, test = train_test_sets(df_first, random_state=random_state,
+                                  added_features_list=added_features_list)
+    if period != first_period:
+        train, test = train_test_sets(notes_by_period[period],
+                                      random_state=random_state,
+                                      added_features_list=added_features_list,
+                                      test_ids=test['id'].copy().tolist(),
+                                      idlist=df_first['id'].copy().tolist())
+
+    results_period = lr_cv_period(train, test, period,
+                                  random_state=random_state,
+                                  model_path=model_path, trace=trace,
+                                  **period_options)
+    if checkpoint is not None:
+        dump_atomic(results_period, checkpoint)
+    return results_period
+
+
+def lr_cv_batch(disease, period_lists, random_state_list, year_survival=5,
+                kfold=5, authortype_list=None, added_features_list=None,
+                text_search='grid', stage_search='grid', cache_dir=None,
+                cache_size=8e9, oversampling='rows', arena_dir=None,
+                checkpoint_dir=None, n_jobs=1, search_jobs=1,
+                vectorizer='tokens', model_dir=None, memo_dir=None,
+                trace_path=None, profile_stage=None):
+    """
+    This generator runs lr_cv for every list of time points in
+    'period_lists' (experiments with different starting points) and every
+    seed in 'random_state_list'. The seed x time point jobs of all the
+    experiments are spread across a pool of 'n_jobs' processes, and the
+    notes of every time point are concatenated once and shared by all the
+    jobs (as positions in the arena, or saved in a file that each worker
+    loads for the time points of its current job). It yields (k, results_list) as soon as all the jobs of
+    period_lists[k] are done, where results_list has the lr_cv output
+    dictionary of each seed, in the order of 'random_state_list'.
+
+    With 'checkpoint_dir', the result of each seed x time point job is saved
+    in this folder as soon as it is done, and the jobs already saved (by an
+    interrupted run with the same settings) are loaded instead of being
+    computed again.
+
+    Parameters
+    ----------
+     disease, year_survival, kfold, authortype_list, added_features_list,
+     text_search, stage_search, cache_dir, cache_size, oversampling,
+     arena_dir, search_jobs, vectorizer, memo_dir, trace_path,
+     profile_stage:
+         Same as in lr_cv (the worker processes append their stages to the
+         same trace).
+     checkpoint_dir:
+         Folder of the checkpoints of the jobs (None to disable them).
+     model_dir:
+         Same as in lr_cv (the models are only saved by the jobs that are
+         computed, not by the ones loaded from a checkpoint).
+     period_lists:
+         List of lists of number of days after diagnosis considered to
+         select the notes (period_of_analysis_days of each experiment).
+     random_state_list:
+         List of seeds used by the random number generator.
+     n_jobs:
+         Number of worker processes (1 runs the jobs in this process).
+    """
+    trace = StageTrace(trace_path, profile_stage,
+                       disease=getattr(disease, 'disease', disease))
+    trace.begin('load_notes')
+    corpus = load_corpus(disease, year_survival=year_survival,
+                         authortype_list=authortype_list)
+    arena = None
+    if arena_dir is not None:
+        arena = load_arena(corpus, arena_dir, added_features_list)
+        if corpus is not disease:
+            # The corpus was loaded here, only its arena is used.
+            corpus.release_texts()
+    trace.end()
+    periods = sorted(set(period for period_of_analysis_days in period_lists
+                         for period in period_of_analysis_days))
+    notes_by_period = dict(iter_combined_notes(
+        corpus, periods, year_survival=year_survival,
+        authortype_list=authortype_list,
+        added_features_list=added_features_list, arena=arena, trace=trace))
+    memo = None
+    if memo_dir is not None:
+        memo = FitMemo(memo_dir, context=corpus.version(), max_bytes=cache_size)
+    initargs = (notes_by_period, added_features_list,
+                dict(kfold=kfold, text_search=text_search,
+                     stage_search=stage_search, cache_dir=cache_dir,
+                     cache_size=cache_size, oversampling=oversampling,
+                     arena=arena, search_jobs=search_jobs,
+                     vectorizer=vectorizer, memo=memo, trace=trace))
+
+    # Jobs of each experiment, seed by seed.
+    jobs = [(k, (random_state, period, period_of_analysis_days[0]))
+            for k, period_of_analysis_days in enumerate(period_lists)
+            for random_state in random_state_list
+            for period in period_of_analysis_days]
+    results_jobs = [None]*len(jobs)
+    remaining = [len(random_state_list)*len(period_of_analysis_days)
+                 for period_of_analysis_days in period_lists]
+    first_job = np.concatenate([[0], np.cumsum(remaining)[:-1]]).astype(int)
+
+    # Checkpoint file of each job. The name has the first time point, the
+    # seed, the time point and a hash of the notes and the settings of the
+    # run, so a run on other notes or settings does not reuse them.
+    checkpoints = [None]*len(jobs)
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        settings = joblib_hash((corpus.version(), year_survival,
+                                corpus.days_sur_bounds, authortype_list,
+                                added_features_list, kfold, text_search,
+                                stage_search, oversampling, arena is None,
+                                vectorizer))
+        checkpoints = [os.path.join(checkpoint_dir,
+                                    f'{first_period}_{random_state}_'
+                                    f'{period}_{settings}.pkl')
+                       for _, (random_state, period, first_period) in jobs]
+
+    def job_done(j, results_period):
+        # Record a job and return the results of its experiment when it is
+        # the last one.
+        k = jobs[j][0]
+        results_jobs[j] = results_period
+        remaining[k] -= 1
+        if remaining[k]:
+            return None
+        start = first_job[k]
+        n_periods = len(period_lists[k])
+        return k, [collect_lr_cv_results(
+            results_jobs[start + i*n_periods:start + (i+1)*n_periods],
+            random_state) for i, random_state in enumerate(random_state_list)]
+
+    # Files of the final models of each job.
+    model_paths = [model_file(model_dir, first_period, random_state, period)
+                   for _, (random_state, period, first_period) in jobs]
+    if model_dir is not None:
+        os.makedirs(model_dir, exist_ok=True)
+
+    # Jobs completed by a previous run.
+    todo = []
+    for j, checkpoint in enumerate(checkpoints):
+        if checkpoint is None or not os.path.exists(checkpoint):
+            todo.append(j)
+            continue
+        done = job_done(j, load(checkpoint))
+        if done is not None:
+            yield done
+
+    if n_jobs == 1:
+        init_lr_cv_worker(*initargs)
+        for j in todo:
+            done = job_done(j, run_lr_cv_job(*jobs[j][1], checkpoints[j],
+                                             model_paths[j]))
+            if done is not None:
+                yield done
+    elif todo:
+        # The workers receive the arena positions of the notes or, without
+        # arena, the path of a joblib file with the notes of each time point,
+        # loaded when a job needs them (the texts of all the time points are
+        # never copied to every worker).
+        notes_folder = None
+        if arena is None:
+            notes_folder = mkdtemp()
+            for period in notes_by_period:
+                path = os.path.join(notes_folder, f'notes_{period}.pkl')
+                dump(notes_by_period[period], path)
+                notes_by_period[period] = path
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=init_lr_cv_worker,
+                                     initargs=initargs) as executor:
+                futures = {executor.submit(run_lr_cv_job, *jobs[j][1],
+                                           checkpoints[j], model_paths[j]): j
+                           for j in todo}
+                for future in as_completed(futures):
+                    done = job_done(futures[future], future.result())
+                    if done is not None:
+                        yield done
+        finally:
+            if notes_folder is not None:
+                rmtree(notes_folder, ignore_errors=True)
+
+
+def lr_cv_seeds(disease, random_state_list, year_survival=5,
+                period_of_analysis_days=None, kfold=5, authortype_list=None,
+                added_features_list=None, text_search='grid',
+                stage_search='grid', cache_dir=None, cache_size=8e9,
+                oversampling='rows', arena_dir=None, checkpoint_dir=None,
+                n_jobs=1, search_jobs=1, vectorizer='tokens',
+                model_dir=None, memo_dir=None, trace_path=None,
+                profile_stage=None):
+    """
+    This function runs lr_cv for every seed in 'random_state_list', with the
+    seed x time point jobs spread across a pool of 'n_jobs' processes (see
+    lr_cv_batch).
+
+    Parameters
+    ----------
+     disease, year_survival, period_of_analysis_days, kfold, authortype_list,
+     added_features_list, text_search, stage_search, cache_dir, cache_size,
+     oversampling, arena_dir, search_jobs, vectorizer, memo_dir, trace_path,
+     profile_stage:
+         Same as in lr_cv.
+     random_state_list:
+         List of seeds used by the random number generator.
+     checkpoint_dir, model_dir:
+         Same as in lr_cv_batch.
+     n_jobs:
+         Number of worker processes (1 runs the jobs in this process).
+
+    Return
+    ------
+    List with the lr_cv output dictionary of each seed, in the order of
+    'random_state_list'.
+    """
+    if period_of_analysis_days is None:
+        period_of_analysis_days = [30, 365]
+
+    _, results_list = next(lr_cv_batch(
+        disease, [period_of_analysis_days], random_state_list,
+        year_survival=year_survival, kfold=kfold,
+        authortype_list=authortype_list,
+        added_features_list=added_features_list, text_search=text_search,
+        stage_search=stage_search, cache_dir=cache_dir,
+        cache_size=cache_size, oversampling=oversampling,
+        arena_dir=arena_dir, checkpoint_dir=checkpoint_dir, n_jobs=n_jobs,
+        search_jobs=search_jobs, vectorizer=vectorizer,
+        model_dir=model_dir, memo_dir=memo_dir, trace_path=trace_path,
+        profile_stage=profile_stage))
+    return results_list
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# FUNCTIONS FOR METRICS WITH CONFIDENCE INTERVALS
+# ---------------------------------------------------------------------------
+def result_period(test):
+    """Time point of the test set 'test' of an lr_cv output (from the name
+    of its prediction column)."""
+    return int([name for name in test.columns
+                if name.endswith('_tf_pred')][0][:-len('_tf_pred')])
+
+
+def bootstrap_metrics(results_list, n_bootstraps=1000, alpha=0.05,
+                      random_state=0, batch_size=50):
+    """
+    This function computes the AUC of the predicted probabilities and the F1
+    score (macro) of the predictions on the test set of every seed, time
+    point and approach (text and stage/grade) of a list of lr_cv outputs,
+    with bootstrap confidence intervals. The test sets of all the runs are
+    concatenated in a single array, and each batch of 'batch_size'
+    bootstrap resamples is a matrix of multinomial weights of the rows, so
+    the metrics of all the runs and resamples are computed with array
+    operations (weighted Mann-Whitney statistic for the AUC). Without
+    resampling, the values are the ones of roc_auc_score and
+    f1_score(average='macro').
+
+    Parameters
+    ----------
+     results_list:
+         List of lr_cv output dictionaries (with the keys 'probabilities',
+         'probabilities_s' and the 'test' sets).
+     n_bootstraps:
+         Number of bootstrap resamples of each test set.
+     alpha:
+         The confidence intervals are the percentiles alpha/2 and
+         1 - alpha/2 of the bootstrap values.
+     random_state:
+         Seed used by the random number generator.
+     batch_size:
+         Number of resamples computed at once.
+
+    Return
+    ------
+    DataFrame with the columns 'random_state', 'period', 'approach' ('text'
+    or 'stage'), 'metric' ('auc' or 'f1'), 'value', 'std' (standard
+    deviation of the bootstrap values), 'ci_lower' and 'ci_upper'.
+    """
+    runs = []
+    for results in results_list:
+        for k, test in enumerate(results['test']):
+            for approach, suffix in (('text', ''), ('stage', '_s')):
+                runs.append((results['random_state'], result_period(test),
+                             approach, test['label'].values,
+                             results['probabilities' + suffix][k],
+                             results['predictions' + suffix][k]))
+
+    # Rows of all the runs, each run in increasing order of probability.
+    lengths = np.array([len(run[3]) for run in runs])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    run_of = np.repeat(np.arange(len(runs)), lengths)
+    order = np.concatenate([start + np.argsort(run[4], kind='stable')
+                            for start, run in zip(starts, runs)])
+    y = np.concatenate([run[3] for run in runs])[order]
+    probabilities = np.concatenate([run[4] for run in runs])[order]
+    predictions = np.concatenate([run[5] for run in runs])[order]
+
+    # Groups of tied probabilities (contiguous in each run).
+    new_group = np.ones(len(y), dtype=bool)
+    new_group[1:] = ((probabilities[1:] != probabilities[:-1]) |
+                     (run_of[1:] != run_of[:-1]))
+    group_starts = np.flatnonzero(new_group)
+    run_groups = np.searchsorted(group_starts, starts)
+    group_run = run_of[group_starts]
+
+    def metrics(weights):
+        # AUC and F1 of each run for each row of weights (resample).
+        positives = np.add.reduceat(weights*(y == 1), group_starts, axis=1)
+        negatives = np.add.reduceat(weights*(y == 0), group_starts, axis=1)
+        below = np.cumsum(negatives, axis=1) - negatives
+        below -= below[:, run_groups][:, group_run]
+        pairs = np.add.reduceat(positives*(below + 0.5*negatives),
+                                run_groups, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            auc = pairs/(np.add.reduceat(positives, run_groups, axis=1) *
+                         np.add.reduceat(negatives, run_groups, axis=1))
+
+            # F1 of each label present in the labels or the predictions.
+            f1_sum = 0
+            n_labels = 0
+            for label in (0, 1):
+                tp = np.add.reduceat(
+                    weights*((y == label) & (predictions == label)), starts,
+                    axis=1)
+                errors = np.add.reduceat(
+                    weights*((y == label) != (predictions == label)), starts,
+                    axis=1)
+                f1_sum = f1_sum + np.where(tp + errors > 0,
+                                           2*tp/(2*tp + errors), 0)
+                n_labels = n_labels + (tp + errors > 0)
+            f1 = f1_sum/n_labels
+        return auc, f1
+
+    auc, f1 = metrics(np.ones((1, len(y))))
+    rng = np.random.default_rng(random_state)
+    auc_bootstraps = []
+    f1_bootstraps = []
+    for start in range(0, n_bootstraps, batch_size):
+        n_batch = min(batch_size, n_bootstraps - start)
+        rows = starts[run_of] + (rng.random((n_batch, len(y))) *
+                                 lengths[run_of]).astype(np.int64)
+        weights = np.bincount(
+            (np.arange(n_batch)[:, np.newaxis]*len(y) + rows).ravel(),
+            minlength=n_batch*len(y)).reshape(n_batch, len(y))
+        auc_batch, f1_batch = metrics(weights)
+        auc_bootstraps.append(auc_batch)
+        f1_bootstraps.append(f1_batch)
+
+    table = []
+    for metric, value, bootstraps in (('auc', auc, auc_bootstraps),
+                                      ('f1', f1, f1_bootstraps)):
+        bootstraps = np.concatenate(bootstraps)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            std = np.nanstd(bootstraps, axis=0)
+            ci_lower, ci_upper = np.nanpercentile(
+                bootstraps, [100*alpha/2, 100*(1 - alpha/2)], axis=0)
+        table.append(pd.DataFrame({
+            'random_state': [run[0] for run in runs],
+            'period': [run[1] for run in runs],
+            'approach': [run[2] for run in runs],
+            'metric': metric, 'value': value[0], 'std': std,
+            'ci_lower': ci_lower, 'ci_upper': ci_upper}))
+    return pd.concat(table, ignore_index=True)
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# FUNCTIONS TO SAVE AND LOAD RESULTS
+# ---------------------------------------------------------------------------
+
+# Outputs of lr_cv stored in the rows of the results table.
+row_keys = ['predictions', 'probabilities', 'predictions_s',
+            'probabilities_s', 'train', 'test']
+
+
+def save_lr_cv_results(results_list, path, corpus=None):
+    """
+    This function saves a list of lr_cv outputs (one for each seed) in the
+    compact Parquet file 'path'. The rows of the training and test sets of
+    every seed and time point are stored in a single typed table, without
+    the concatenated text, with the columns 'random_state', 'period',
+    'tf_pred', 's_pred' (predictions of the two approaches), 'tf_prob' and
+    's_prob' (probabilities, test rows only). The other outputs and the
+    version of 'corpus' (NotesCorpus.version) are stored in the metadata of
+    the file. load_lr_cv_results rebuilds the lr_cv outputs.
+
+    Parameters
+    ----------
+     results_list:
+         List of lr_cv output dictionaries.
+     path:
+         Name of the Parquet file.
+     corpus:
+         NotesCorpus used to compute the results (None if unknown).
+    """
+    rows = []
+    runs = []
+    for results in results_list:
+        random_state = results['random_state']
+        periods = []
+        columns = []
+        for k, (train, test) in enumerate(zip(results['train'],
+                                              results['test'])):
+            period = result_period(test)
+            periods.append(period)
+            columns.append([name.replace(f'{period}_', '', 1) if
+                            name in (f'{period}_tf_pred', f'{period}_s_pred')
+                            else name for name in test.columns
+                            if name != 'text'])
+            for frame in (train, test):
+                rows_k = frame.drop(columns=['text', f'{period}_tf_pred',
+                                             f'{period}_s_pred'],
+                                    errors='ignore')
+                rows_k.insert(0, 'period', period)
+                rows_k.insert(0, 'random_state', random_state)
+                rows_k['tf_pred'] = frame[f'{period}_tf_pred'].values
+                rows_k['s_pred'] = frame[f'{period}_s_pred'].values
+                rows_k['tf_prob'] = np.nan
+                rows_k['s_prob'] = np.nan
+                if frame is test and 'probabilities' in results:
+                    rows_k['tf_prob'] = results['probabilities'][k]
+                    rows_k['s_prob'] = results['probabilities_s'][k]
+                rows.append(rows_k)
+        outputs = {key: value for key, value in results.items()
+                   if key not in row_keys + ['random_state']}
+        runs.append(dict(random_state=random_state, periods=periods,
+                         columns=columns, keys=list(results),
+                         outputs=outputs))
+
+    info = dict(version=1, runs=runs,
+                tuple_keys=[key for key, value in runs[0]['outputs'].items()
+                            if value and isinstance(value[0], tuple)],
+                corpus=None if corpus is None else dict(
+                    disease=corpus.disease,
+                    year_survival=corpus.year_survival,
+                    days_sur_bounds=corpus.days_sur_bounds,
+                    authortype_list=corpus.authortype_list,
+                    version=corpus.version()))
+
+    table = pa.Table.from_pandas(pd.concat(rows, ignore_index=True),
+                                 preserve_index=False)
+    table = table.replace_schema_metadata(dict(
+        table.schema.metadata,
+        lr_cv=json.dumps(info, default=lambda value: value.item())))
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_lr_cv_results(path, frames=True, corpus=None):
+    """
+    This function loads the file of save_lr_cv_results and returns the list
+    of lr_cv output dictionaries. The 'train' and 'test' sets are rebuilt
+    from the rows of the file (without the 'text' column) when 'frames' is
+    True, otherwise only the other outputs are loaded.
+
+    Parameters
+    ----------
+     path:
+         Name of the Parquet file.
+     frames:
+         Rebuild the 'train' and 'test' sets.
+     corpus:
+         If given, a ValueError is raised when the results were computed
+         with another version of the corpus.
+    """
+    table = pq.read_table(path)
+    info = json.loads(table.schema.metadata[b'lr_cv'])
+    if (corpus is not None and info['corpus'] is not None and
+            info['corpus']['version'] != corpus.version()):
+        raise ValueError(f'{path} was computed with another version of the '
+                         f'{corpus.disease} corpus.')
+
+    rows = table.to_pandas()
+    groups = rows.groupby(['random_state', 'period', 'is_test'],
+                          sort=False).indices
+    empty = np.array([], dtype=np.int64)
+
+    results_list = []
+    for run in info['runs']:
+        outputs = {key: [tuple(value) for value in values]
+                   if key in info['tuple_keys'] else values
+                   for key, values in run['outputs'].items()}
+        for key in row_keys:
+            outputs[key] = []
+        for period, columns in zip(run['periods'], run['columns']):
+            sets = []
+            for is_test in (False, True):
+                frame = rows.iloc[groups.get((run['random_state'], period,
+                                              is_test), empty)]
+                sets.append(frame)
+            train, test = sets
+            outputs['predictions'].append(test['tf_pred'].values)
+            outputs['predictions_s'].append(test['s_pred'].values)
+            outputs['probabilities'].append(test['tf_prob'].values)
+            outputs['probabilities_s'].append(test['s_prob'].values)
+            if frames:
+                names = {'tf_pred': f'{period}_tf_pred',
+                         's_pred': f'{period}_s_pred'}
+                for key, frame in (('train', train), ('test', test)):
+                    outputs[key].append(frame[columns].rename(
+                        columns=names).reset_index(drop=True))
+        outputs['random_state'] = run['random_state']
+        results_list.append({key: outputs[key] for key in run['keys']
+                             if frames or key not in ('train', 'test')})
+
+    return results_list
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# FUNCTIONS TO SCORE NEW PATIENTS
+# ---------------------------------------------------------------------------
+def model_file(model_dir, first_period, random_state, period):
+    """File of the PeriodModel of one seed x time point in 'model_dir' (None
+    when 'model_dir' is None)."""
+    if model_dir is None:
+        return None
+    return os.path.join(model_dir,
+                        f'{first_period}_{random_state}_{period}.pkl')
+
+
+class PeriodModel:
+    """PeriodModel
+    Final models of lr_cv at one time point, used to score the notes of new
+    patients (see score_notes): the tf-idf vectorizer and the
+    LogisticRegression of the text, and the pipeline of the stage/grade.
+    The vectorizer of the terms only keeps the selected terms
+    ('vocabulary'), the hashing vectorizer does not need a vocabulary.
+    """
+
+    def __init__(self, period, random_state, text_model, stage_model, terms):
+        self.period = period
+        self.random_state = random_state
+        self.vectorizer = copy.copy(text_model['tfidfvectorizer'])
+        self.classifier = text_model['logisticregression']
+        self.stage_model = stage_model
+        if isinstance(self.vectorizer, HashingTfidfVectorizer):
+            self.vocabulary = None
+            self.vectorizer.buckets = None
+            self.vectorizer.reverse_map_ = None
+        else:
+            self.vocabulary = terms[self.vectorizer.token_ids_]
+            self.vectorizer.token_ids_ = np.arange(len(self.vocabulary))
+
+    def transform_text(self, documents, terms):
+        """Tf-idf matrix of 'documents' (token ids of tokenize_documents,
+        with the terms 'terms')."""
+        if self.vocabulary is None:
+            vectorizer = copy.copy(self.vectorizer)
+            vectorizer.buckets = hash_terms(terms)
+            return vectorizer.transform(documents)
+
+        # Position of each term in the vocabulary (-1 when it is absent).
+        columns = np.searchsorted(self.vocabulary, terms)
+        columns[columns == len(self.vocabulary)] = 0
+        columns = np.where(self.vocabulary[columns] == terms, columns, -1)
+        return self.vectorizer.transform([columns[document]
+                                          for document in documents])
+
+    def predict_proba(self, documents, terms, stage_grade):
+        """Probabilities of the label 1 from the text ('documents', 'terms')
+        and from the stage/grade of the patients."""
+        probabilities = self.classifier.predict_proba(
+            self.transform_text(documents, terms))[:, 1]
+        probabilities_s = self.stage_model.predict_proba(
+            pd.DataFrame({'stage_grade': stage_grade}))[:, 1]
+        return probabilities, probabilities_s
+
+
+def load_period_models(model_dir, first_period, random_state):
+    """PeriodModel of each time point of the lr_cv run with the first time
+    point 'first_period' and the seed 'random_state', saved in 'model_dir',
+    in increasing order of the time points."""
+    prefix = f'{first_period}_{random_state}_'
+    models = [load(os.path.join(model_dir, name))
+              for name in os.listdir(model_dir)
+              if name.startswith(prefix) and name.endswith('.pkl')]
+    return sorted(models, key=lambda model: model.period)
+
+
+def scoring_notes(df_Notes, authortype_list=None):
+    """This function applies the filters of NotesCorpus that do not depend on
+    the survival to the notes of new patients (null notes, authors and notes
+    before the diagnosis), removes the notes without stage/grade, and orders
+    the notes by 'id' and 'filingdate'."""
+    df_Notes = df_Notes[~df_Notes['deid_notecontent'].isnull() &
+                        ~df_Notes['stage_grade'].isnull() &
+                        (df_Notes['filingdate'] >=
+                         df_Notes['dateofdiagnosis'])]
+    if authortype_list is not None:
+        df_Notes = df_Notes[df_Notes['authortype'].isin(authortype_list)]
+    df_Notes = df_Notes.sort_values(by=['id', 'filingdate'],
+                                    ascending=[True, True],
+                                    na_position='last', inplace=False)
+    df_Notes.reset_index(inplace=True, drop=True)
+    df_Notes['daysfromdiagnostic'] = days_from_diagnostic(df_Notes).astype(
+        np.int64)
+    return df_Notes
+
+
+def score_patients(models, df_Notes, minimun_number_of_notes=3):
+    """This function scores the patients of 'df_Notes' (output of
+    scoring_notes) with each PeriodModel of 'models' (see score_notes)."""
+    timeline = PatientTimeline(df_Notes)
+    note_documents, terms = tokenize_documents(
+        df_Notes['deid_notecontent'].tolist())
+    note_documents = note_documents.values
+    stage_grade = df_Notes['stage_grade'].values[timeline.note_start]
+
+    scores = []
+    for model in models:
+        selected, id_count = timeline.select(model.period,
+                                             minimun_number_of_notes)
+        patients = np.flatnonzero(id_count >= minimun_number_of_notes)
+        if not len(patients):
+            continue
+
+        # Document of each patient: token ids of its notes in the window.
+        positions = np.flatnonzero(selected)
+        codes = timeline.id_codes[positions]
+        documents = [np.concatenate(list(note_documents[notes]))
+                     for notes in np.split(
+                         positions, np.flatnonzero(np.diff(codes)) + 1)]
+
+        probabilities, probabilities_s = model.predict_proba(
+            documents, terms, stage_grade[patients])
+        scores.append(pd.DataFrame({'id': timeline.ids[patients],
+                                    'period': model.period,
+                                    'id_count': id_count[patients],
+                                    'probability': probabilities,
+                                    'probability_s': probabilities_s}))
+
+    if not scores:
+        return pd.DataFrame(columns=['id', 'period', 'id_count',
+                                     'probability', 'probability_s'])
+    return pd.concat(scores, ignore_index=True)
+
+
+def score_notes(models, notes, authortype_list=None, batch_size=1000,
+                minimun_number_of_notes=3):
+    """
+    This generator scores the notes of new patients with the final models of
+    lr_cv (list of PeriodModel, see load_period_models). The patients are
+    scored by micro-batches of 'batch_size' patients. Each note is tokenized
+    once, and the document of a patient at a time point is the
+    concatenation of the token ids of its notes in the first 'period' days
+    from diagnosis (the tokens of the text of combined_notes). As in
+    combined_notes, a patient is only scored at the time points with at
+    least 'minimun_number_of_notes' notes. For each micro-batch, it yields a
+    DataFrame with the columns 'id', 'period', 'id_count', 'probability'
+    (text) and 'probability_s' (stage/grade), the probabilities of the
+    label 1 (survival longer than 'year_survival').
+
+    Parameters
+    ----------
+     models:
+         List of PeriodModel (one for each time point).
+     notes:
+         DataFrame of notes with the columns 'id', 'deid_notecontent',
+         'authortype', 'filingdate', 'dateofdiagnosis' and 'stage_grade',
+         or iterable of such DataFrames (stream). All the notes of a
+         patient must be in the same DataFrame.
+     authortype_list:
+         List of authors considered as valid (None keeps all the notes).
+     batch_size:
+         Number of patients of each micro-batch.
+     minimun_number_of_notes:
+         Minimum number of notes in the window of a time point.
+    """
+    if isinstance(notes, pd.DataFrame):
+        notes = [notes]
+    for df_Notes in notes:
+        df_Notes = scoring_notes(df_Notes, authortype_list=authortype_list)
+        timeline = PatientTimeline(df_Notes)
+        for start in range(0, len(timeline.ids), batch_size):
+            stop = min(start + batch_size, len(timeline.ids))
+            df_batch = df_Notes.iloc[timeline.note_start[start]:
+                                     timeline.note_stop[stop - 1]]
+            yield score_patients(models, df_batch.reset_index(drop=True),
+                                 minimun_number_of_notes)
 # ---------------------------------------------------------------------------
 
 # ***************************************************************************
\ No newline at end of file
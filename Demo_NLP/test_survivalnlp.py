@@ -0,0 +1,247 @@
+"""
+Tests of survivalnlp.py (run with 'python -m pytest' in Demo_NLP).
+
+The nested train/test split and the CatStratifiedKFold folds computed on
+integer positions are compared with the previous implementations, which
+selected and concatenated the rows of the dataframes. The corpus tests use
+the synthetic notes of benchmarknlp.py.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sklearn.model_selection import StratifiedKFold, train_test_split
+
+from survivalnlp import (nested_train_test_indices, nested_train_test_split,
+                         CatStratifiedKFold, NotesCorpus, load_arena,
+                         lr_cv)
+from benchmarknlp import synthetic_notes, synthetic_authors
+
+
+# ---------------------------------------------------------------------------
+# Reference implementations (list/concat versions).
+# ---------------------------------------------------------------------------
+
+def reference_nested_train_test_split(df, examples_col_names,
+                                      labels_col_names, train_frac=0.8,
+                                      random_state=42):
+    df = pd.merge(df,
+                  df.groupby(labels_col_names).size().to_frame(name='count').reset_index(),
+                  on=labels_col_names,
+                  how='left')
+
+    train_one_member = None
+    if 1 in df['count'].values:
+        train_one_member = df[df['count'] == 1].copy().reset_index(drop=True)
+        train_frac = (train_frac*len(df)-len(train_one_member))/(len(df)-len(train_one_member))
+        df = df[df['count'] > 1].copy().reset_index(drop=True)
+    df.drop(columns=['count'], inplace=True)
+
+    train = None
+    test = None
+    for i in df[labels_col_names[0]].value_counts().index.tolist():
+        labels = df[df[labels_col_names[0]].astype(str) == i][labels_col_names[1]].copy()
+        labels.reset_index(inplace=True, drop=True)
+        examples = df[df[labels_col_names[0]].astype(str) == i][examples_col_names].copy()
+        examples.reset_index(inplace=True, drop=True)
+
+        X_tr, X_te, y_tr, y_te = train_test_split(examples,
+                                                  labels,
+                                                  train_size=train_frac,
+                                                  stratify=labels,
+                                                  random_state=random_state)
+
+        train_i = pd.concat([y_tr, X_tr], axis=1).reset_index(drop=True)
+        train_i = train_i.loc[:, ~train_i.columns.duplicated()]
+        test_i = pd.concat([y_te, X_te], axis=1).reset_index(drop=True)
+        test_i = test_i.loc[:, ~test_i.columns.duplicated()]
+        if train is None:
+            train = train_i
+            test = test_i
+        else:
+            train = pd.concat([train, train_i], axis=0, ignore_index=True)
+            test = pd.concat([test, test_i], axis=0, ignore_index=True)
+    if train_one_member is not None:
+        train = pd.concat([train, train_one_member[train.columns]], axis=0,
+                          ignore_index=True)
+
+    return train, test
+
+
+def reference_cat_stratified_split(X, y, n_splits=5, random_state=None,
+                                   shuffle=True):
+    categories = X['stage_grade'].value_counts().index.tolist()
+    X_idx = [0]*len(categories)
+    y_val = [0]*len(categories)
+    skf = [0]*len(categories)
+    for k, j in enumerate(categories):
+        X_idx[k] = X[X['stage_grade'] == j].copy().index
+        y_val[k] = y[X['stage_grade'] == j].copy()
+        skf[k] = StratifiedKFold(n_splits=n_splits,
+                                 random_state=random_state,
+                                 shuffle=shuffle).split(X_idx[k], y_val[k])
+
+    for indexes in zip(*skf):
+        i_train = []
+        i_test = []
+        for i, index in enumerate(indexes):
+            i_train += X_idx[i][list(index[0])].tolist()
+            i_test += X_idx[i][list(index[1])].tolist()
+        yield np.array(i_train), np.array(i_test)
+
+
+# ---------------------------------------------------------------------------
+# Data.
+# ---------------------------------------------------------------------------
+
+def patients(seed, index=None):
+    """Dataframe of combined notes (one row per patient and stage/grade):
+    the patient 'p0' has several stage rows and the (stage_grade, label)
+    pairs of 'p1' and 'p2' have a single member."""
+    rng = np.random.RandomState(seed)
+    n = 120
+    df = pd.DataFrame({
+        'id': [f'p{i}' for i in range(n)],
+        'stage_grade': rng.choice(['2', '3', '4', 'UNK'], size=n,
+                                  p=[0.4, 0.3, 0.2, 0.1]),
+        'label': rng.randint(0, 2, size=n),
+        'AGE': rng.randint(30, 90, size=n),
+        'text_length': rng.randint(100, 10000, size=n)})
+    several_stages = pd.DataFrame({'id': ['p0']*3,
+                                   'stage_grade': ['2', '3', '4'],
+                                   'label': [1, 1, 1],
+                                   'AGE': [55]*3,
+                                   'text_length': [500, 700, 900]})
+    one_member = pd.DataFrame({'id': ['p1', 'p2'],
+                               'stage_grade': ['T1', 'T2'],
+                               'label': [0, 1],
+                               'AGE': [40, 70],
+                               'text_length': [300, 400]})
+    df = pd.concat([df, several_stages, one_member], ignore_index=True)
+    df = df.iloc[rng.permutation(len(df))].reset_index(drop=True)
+    if index is not None:
+        df.index = index(len(df))
+    return df
+
+
+# ---------------------------------------------------------------------------
+# Tests.
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize('random_state', [0, 7, 42])
+@pytest.mark.parametrize('train_frac', [0.8, 0.7])
+def test_nested_train_test_split(random_state, train_frac):
+    df = patients(random_state)
+    examples_col_names = ['id', 'stage_grade', 'AGE', 'text_length']
+    labels_col_names = ['stage_grade', 'label']
+
+    train, test = nested_train_test_split(df, examples_col_names,
+                                          labels_col_names,
+                                          train_frac=train_frac,
+                                          random_state=random_state)
+    ref_train, ref_test = reference_nested_train_test_split(
+        df, examples_col_names, labels_col_names, train_frac=train_frac,
+        random_state=random_state)
+
+    pd.testing.assert_frame_equal(train, ref_train)
+    pd.testing.assert_frame_equal(test, ref_test)
+    assert set(train['id']) >= {'p1', 'p2'}
+    assert (df['id'] == 'p0').sum() == ((train['id'] == 'p0').sum() +
+                                        (test['id'] == 'p0').sum())
+
+
+@pytest.mark.parametrize('random_state', [0, 7, 42])
+def test_nested_train_test_indices(random_state):
+    df = patients(random_state, index=lambda n: np.arange(n)*3 + 5)
+    i_train, i_test = nested_train_test_indices(
+        df, ['stage_grade', 'label'], random_state=random_state)
+    train, test = nested_train_test_split(
+        df, ['id'], ['stage_grade', 'label'], random_state=random_state)
+
+    assert len(np.intersect1d(i_train, i_test)) == 0
+    assert len(i_train) + len(i_test) == len(df)
+    assert df['id'].iloc[i_train].tolist() == train['id'].tolist()
+    assert df['id'].iloc[i_test].tolist() == test['id'].tolist()
+
+
+@pytest.mark.parametrize('random_state', [0, 7, 42])
+@pytest.mark.parametrize('index', [None, lambda n: np.arange(n)*3 + 5])
+def test_cat_stratified_kfold(random_state, index):
+    df = patients(random_state, index=index)
+    df = df[df['stage_grade'].isin(['2', '3', '4', 'UNK'])]
+    X = df[['id', 'stage_grade', 'AGE']]
+    y = df['label']
+
+    folds = list(CatStratifiedKFold(n_splits=3,
+                                    random_state=random_state).split(X, y))
+    ref_folds = list(reference_cat_stratified_split(
+        X, y, n_splits=3, random_state=random_state))
+
+    assert len(folds) == len(ref_folds) == 3
+    for (i_train, i_test), (ref_train, ref_test) in zip(folds, ref_folds):
+        np.testing.assert_array_equal(i_train, ref_train)
+        np.testing.assert_array_equal(i_test, ref_test)
+
+
+def corpus(n_patients=60, random_state=0):
+    """NotesCorpus of synthetic notes."""
+    return NotesCorpus('synthetic',
+                       df_Notes=synthetic_notes(n_patients=n_patients,
+                                                random_state=random_state,
+                                                n_terms=500, mean_notes=8),
+                       authortype_list=list(synthetic_authors),
+                       added_features_list=['AGE'])
+
+
+@pytest.mark.parametrize('column, value', [
+    ('vitalstatusbinary', lambda x: 1 - x),
+    ('overallsurvival', lambda x: x + 0.5),
+    ('stage_grade', lambda x: '4' if x != '4' else '1'),
+    ('AGE', lambda x: x + 1),
+    ('deid_notecontent', lambda x: x + ' w0')])
+def test_corpus_version(column, value):
+    version = corpus().version()
+    assert corpus().version() == version
+
+    changed = corpus()
+    changed.df_Notes.loc[3, column] = value(changed.df_Notes.loc[3, column])
+    assert changed.version() != version
+
+
+def test_memo_with_and_without_arena(tmp_path):
+    kwargs = dict(period_of_analysis_days=[60, 365], random_state=3,
+                  authortype_list=list(synthetic_authors), kfold=3)
+    df_Notes = synthetic_notes(n_patients=300, random_state=0, n_terms=5000,
+                               mean_notes=8)
+
+    corpus = NotesCorpus('synthetic', df_Notes=df_Notes,
+                         authortype_list=list(synthetic_authors))
+
+    def run(**options):
+        return lr_cv(corpus, **kwargs, **options)
+
+    # The arena and the notes in memory number the token ids differently,
+    # so the text models memoized by one run are not reused by the other
+    # (the run with the arena leaves the texts of the corpus).
+    results = run()
+    for options in [dict(arena_dir=str(tmp_path/'arena')), {}]:
+        results_memo = run(memo_dir=str(tmp_path/'memo'), **options)
+        for key in ['f1', 'predictions', 'probabilities', 'f1_s']:
+            for value, value_memo in zip(results[key], results_memo[key]):
+                np.testing.assert_allclose(value, value_memo)
+
+
+def test_release_texts(tmp_path):
+    notes = corpus()
+    version = notes.version()
+    arena = load_arena(notes, str(tmp_path/'arena'))
+    assert 'deid_notecontent' in notes.df_Notes
+    assert len(arena) == len(notes.df_Notes)
+
+    notes.release_texts()
+    assert 'deid_notecontent' not in notes.df_Notes
+    assert notes.version() == version
+    assert len(load_arena(notes, str(tmp_path/'arena'))) == len(arena)
+    with pytest.raises(ValueError):
+        load_arena(notes, str(tmp_path/'other_arena'))
@@ -8,6 +8,9 @@ Results are saved in a pickle object with the following name:
   --> {disease}{starting point}.pickle  (Ex: breast30.pickle),
 where "disease" is one of the options below (breast, prostate, lung or glioma)
 and "starting point" is one of the options below (20, 30 or 60) days.
+With result_format = 'slim', they are saved in a compact Parquet file
+{disease}{starting point}.parquet instead (without the text of the notes),
+loaded with survivalnlp.load_lr_cv_results.
 
 All calculations are repeated for each random seed values defined
 in random_state_list.
@@ -17,6 +20,7 @@ INSTRUCTIONS:
 Please configure the values of the following variables below:
   --> 'cancer_type_index'
   --> 'start_index'
+  --> 'n_jobs' (number of worker processes, set it to the number of cores)
 -----------------------------------------------------------------------------
 REQUIREMENTS:
 
@@ -75,7 +79,8 @@ STATEMENT:
 # ***************************************************************************
 import pickle
 import time
-from survivalnlp import lr_cv
+from survivalnlp import (lr_cv_seeds, NotesCorpus, load_arena,
+                         save_lr_cv_results)
 
 
 # ---------------------------------------------------------------------------
@@ -98,6 +103,11 @@ cancer_type_index = 0 # ASSIGN THE CHOSEN VALUE FOR OPTION 1 HERE
 #                   1 --> 30 days
 #                   2 --> 60 days
 start_index = 1 # ASSIGN THE CHOSEN VALUE FOR OPTION 2 HERE 
+
+# OPTION 3: Number of worker processes used to run the seed x time point
+#           jobs in parallel (1 runs them one after another).
+#           This value is assigned to the "n_jobs" variable.
+n_jobs = 1 # ASSIGN THE CHOSEN VALUE FOR OPTION 3 HERE
 # ---------------------------------------------------------------------------
 
 
@@ -105,15 +115,22 @@ start_index = 1 # ASSIGN THE CHOSEN VALUE FOR OPTION 2 HERE
 # INITIALIZATIONS
 # ---------------------------------------------------------------------------
 
-# List of cancer types and time points
+# List of cancer types, start points and time points
 cancer_type = ['breast', 'prostate', 'lung', 'glioma']
-period_points = [20, 30, 60, 120, 180, 240, 300, 365]
+start_points = [20, 30, 60]
+all_period_points = [20, 30, 60, 120, 180, 240, 300, 365]
+
+
+def select_period_points(start_index):
+    """Time points of the experiment starting at start_points[start_index]
+    days (the 30 days point is skipped when starting at 20 days)."""
+    if start_index == 0:
+        return all_period_points[:1] + all_period_points[2:]
+    return all_period_points[start_index:]
+
+
+period_points = select_period_points(start_index)
 
-if start_index == 0:
-    period_points = period_points[:1] + period_points[2:]
-else:
-    period_points = period_points[start_index:]
-    
 # Threshold to define survival (in years):
 survival_thr_list = [5, 5, 2, 1.17] 
 cancer_year_survival = survival_thr_list[cancer_type_index] 
@@ -133,31 +150,111 @@ authortype_list = ['Physician',
 # List of additional columns
 added_features_list = ['AGE'] 
 
+# Folder of the persistent cache of the fitted tf-idf transforms, reused
+# when the experiment is run again (None to use temporary folders).
+cache_dir = 'transformer_cache'
+
+# Folder of the columnar notes store (None to read df_Notes_{disease}.pkl).
+# --> Note: The store is created once from the pickle with
+# notes_to_parquet(disease, store=notes_store).
+notes_store = None
+
+# Folder of the memory-mapped text arena of the notes, shared by the worker
+# processes (None to keep the concatenated texts in memory).
+arena_dir = None
+
+# Folder of the checkpoints of the seed x time point results. An interrupted
+# run restarted with the same settings only computes the missing results
+# (None to disable the checkpoints).
+checkpoint_dir = 'checkpoints'
+
+# Format of the output file: 'pickle' (list of the lr_cv dictionaries) or
+# 'slim' (Parquet file of save_lr_cv_results).
+result_format = 'pickle'
+
+# Hyperparameter search of the text model ('grid', 'counts', 'path' or
+# 'halving', see lr_cv) and number of worker processes of this search in each
+# job ('counts', 'path' and 'halving' only, the workers share a
+# memory-mapped copy of the document-term counts).
+text_search = 'grid'
+search_jobs = 1
+
+# Hyperparameter search of the stage/grade model ('grid', 'path' or 'rates',
+# see lr_cv).
+stage_search = 'grid'
+
+# Oversampling of the minority class: 'rows' (RandomOverSampler copies the
+# rows) or 'weights' (same draws used as sample weights of
+# LogisticRegression, without copying the rows), see lr_cv.
+oversampling = 'rows'
+
+# Folder where the final models of each seed and time point are saved to
+# score new patients (see survivalnlp.score_notes), None to discard them.
+model_dir = None
+
+# Folder of the memo of the fitted searches and models, reused by the runs
+# with the same training patients and settings, for example when the
+# experiment is run again with more time points (None to disable it).
+memo_dir = None
+
+# JSON-lines file of the wall time, CPU time and peak memory of each stage
+# of the experiment, tagged with the disease, the seed and the time point
+# (see survivalnlp.load_trace), None to disable it. The stage named
+# profile_stage (Ex: 'text_search') is also run under cProfile, and its
+# statistics are saved in .prof files next to the trace.
+trace_path = None
+profile_stage = None
+
 # ---------------------------------------------------------------------------
 
 
 # ---------------------------------------------------------------------------
 # COMPUTATIONS
 # ---------------------------------------------------------------------------
-start = time.time()
-
-# NLP calculations
-results_list = []
-for random_state_value in random_state_list:
-    results_list.append(lr_cv(cancer_type[cancer_type_index],
-                              year_survival=cancer_year_survival,
-                              period_of_analysis_days=period_points,
-                              random_state=random_state_value,
-                              authortype_list=authortype_list,
-                              added_features_list=added_features_list))
-
-# Saving results
-with open(cancer_type[cancer_type_index]+str(period_points[0])+'.pickle', \
- 'wb') as f:
-    pickle.dump(results_list, f, pickle.HIGHEST_PROTOCOL)
-
-print('---DONE!---')
-print('Execution Time: ', time.time() - start)
+if __name__ == '__main__':
+    start = time.time()
+
+    # Load the notes once for all the seeds.
+    corpus = NotesCorpus(cancer_type[cancer_type_index],
+                         year_survival=cancer_year_survival,
+                         authortype_list=authortype_list,
+                         store=notes_store,
+                         added_features_list=added_features_list)
+    if arena_dir is not None:
+        # Only the arena is read by the runs: free the texts.
+        load_arena(corpus, arena_dir, added_features_list)
+        corpus.release_texts()
+
+    # NLP calculations
+    results_list = lr_cv_seeds(corpus, random_state_list,
+                               year_survival=cancer_year_survival,
+                               period_of_analysis_days=period_points,
+                               authortype_list=authortype_list,
+                               added_features_list=added_features_list,
+                               cache_dir=cache_dir,
+                               arena_dir=arena_dir,
+                               checkpoint_dir=checkpoint_dir,
+                               text_search=text_search,
+                               stage_search=stage_search,
+                               oversampling=oversampling,
+                               n_jobs=n_jobs,
+                               search_jobs=search_jobs,
+                               model_dir=model_dir,
+                               memo_dir=memo_dir,
+                               trace_path=trace_path,
+                               profile_stage=profile_stage)
+
+    # Saving results
+    if result_format == 'slim':
+        save_lr_cv_results(results_list, cancer_type[cancer_type_index] +
+                           str(period_points[0]) + '.parquet', corpus=corpus)
+    else:
+        with open(cancer_type[cancer_type_index]+str(period_points[0])+'.pickle', \
+         'wb') as f:
+            pickle.dump(results_list, f, pickle.HIGHEST_PROTOCOL)
+
+    print('---DONE!---')
+    print('Execution Time: ', time.time() - start)
 # ---------------------------------------------------------------------------
 
 # ***************************************************************************